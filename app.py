@@ -1,13 +1,34 @@
 # app.py
-from flask import Flask, render_template, request, redirect, url_for, session, make_response, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, make_response, flash, send_file, g
+from flask import Response, before_render_template, template_rendered, has_request_context, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
-import csv, io, os, datetime
-from openpyxl import Workbook
-from openpyxl.chart import BarChart, Reference
-from openpyxl.utils import get_column_letter
+from sqlalchemy import func, or_, and_, event
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+import abc, base64, csv, functools, hashlib, importlib.util, io, itertools, os, datetime, json, logging, re, sys, threading, time, uuid, zipfile, zlib
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
+
+def lazy_import(name):
+    # Модуль загружается при первом обращении к атрибуту: воркерам и CLI,
+    # которым не нужны аналитика/Excel, импорт не стоит времени и памяти
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# numpy — только для матриц оценок (аналитика админа); openpyxl импортируется
+# внутри функций выгрузки/импорта xlsx
+np = lazy_import("numpy")
+
 # ───────── Flask & DB config ─────────
 app = Flask(__name__)
 
@@ -16,11 +37,80 @@ INSTANCE_DIR = os.path.join(BASE_DIR, "instance")
 os.makedirs(INSTANCE_DIR, exist_ok=True)
 
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-only-CHANGE-ME")
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(INSTANCE_DIR, "data.db")
+# DATABASE_URL — отдельная база (например для бенчмарка), по умолчанию instance/data.db
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "DATABASE_URL", "sqlite:///" + os.path.join(INSTANCE_DIR, "data.db"))
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Профиль БД: dev — настройки по умолчанию; production — WAL и прагмы для SQLite,
+# пул соединений по переменным окружения. Для PostgreSQL достаточно DATABASE_URL.
+DB_PROFILE = os.environ.get("DB_PROFILE", "dev")
+if DB_PROFILE not in ("dev", "production"):
+    raise RuntimeError(f"DB_PROFILE={DB_PROFILE!r}: допустимы значения dev и production")
+IS_SQLITE = app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite")
+
+SQLITE_PRAGMAS = {
+    "dev": {},
+    "production": {
+        # Читатели не ждут писателя; писатель ждёт блокировку, а не падает с
+        # "database is locked"
+        "journal_mode": "WAL",
+        "busy_timeout": os.environ.get("SQLITE_BUSY_TIMEOUT", "10000"),
+        # В WAL режим NORMAL не теряет целостность, fsync только на checkpoint
+        "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        "cache_size": os.environ.get("SQLITE_CACHE_SIZE", "-65536"),  # КиБ, т.е. 64 МБ
+        "mmap_size": os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+        "temp_store": "MEMORY",
+    },
+}[DB_PROFILE]
+
+if DB_PROFILE == "production":
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 20)),
+        "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": not IS_SQLITE,
+    }
+
 db = SQLAlchemy(app)
 
+
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    cur = dbapi_conn.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cur.execute(f"PRAGMA {name}={value}")
+    cur.close()
+
+
+if IS_SQLITE and SQLITE_PRAGMAS:
+    with app.app_context():
+        event.listen(db.engine, "connect", _set_sqlite_pragmas)
+
+# Один писатель оценок за раз. upsert_grades читает старые значения и по ним
+# считает дельты сводной таблицы, поэтому два параллельных сохранения одних и тех
+# же ячеек посчитали бы дельту дважды; в SQLite они ещё и дерутся за блокировку
+# файла. Внутри процесса писатели встают в очередь на lock, между процессами —
+# на блокировку БД: BEGIN IMMEDIATE в SQLite (ждёт busy_timeout),
+# pg_advisory_xact_lock в PostgreSQL (снимается на commit/rollback).
+GRADE_WRITE_LOCK_ID = 0x6772616465  # ключ advisory-блокировки PostgreSQL
+grade_write_lock = threading.Lock()
+
+
+@contextmanager
+def grade_writer():
+    # with grade_writer(): upsert_grades(...); db.session.commit()
+    # Сериализация не отключается: на ней держится GradeChange.seq — лента
+    # изменений и догон матриц считают, что seq растёт в порядке коммитов
+    with grade_write_lock:
+        conn = db.session.connection()
+        if conn.dialect.name == "sqlite":
+            if not conn.connection.dbapi_connection.in_transaction:
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+        elif conn.dialect.name == "postgresql":
+            conn.execute(db.text("SELECT pg_advisory_xact_lock(:id)"), {"id": GRADE_WRITE_LOCK_ID})
+        yield
+
 # ───────── Models ─────────
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -29,6 +119,11 @@ class User(db.Model):
     role = db.Column(db.String(20), nullable=False)  # student / teacher / admin
     fullname = db.Column(db.String(120), nullable=True)
 
+# Имя для списков: ФИО, а если оно пустое — логин (как fullname or username)
+USER_DISPLAY_NAME = func.coalesce(func.nullif(User.fullname, ""), User.username)
+# Индекс по выражению: постраничный список по роли в порядке имени без сортировки
+db.Index("ix_user_role_name", User.role, USER_DISPLAY_NAME, User.id)
+
 class Subject(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=True, nullable=False)
@@ -42,6 +137,111 @@ class Grade(db.Model):
     quarter = db.Column(db.Integer, nullable=False)
     week = db.Column(db.Integer, nullable=True)  # 1..10 (необязательное)
 
+    __table_args__ = (
+        # Одна оценка на ячейку журнала — на этот индекс опирается upsert оценок
+        db.Index("uq_grade_slot", "student_id", "subject_id", "year", "quarter", "week", unique=True),
+        # Страницы ученика: student_id + year (+ quarter)
+        db.Index("ix_grade_student_year", "student_id", "year", "quarter"),
+        # Отчёты по классу/школе: year + фильтры по предмету/четверти/неделе
+        db.Index("ix_grade_year_subject", "year", "subject_id", "quarter", "week"),
+    )
+
+class GradeArchive(db.Model):
+    # Оценки закрытых лет (см. archive_year): колонки Grade, но без вторичных
+    # индексов. Строки лежат подряд по (год, ученик, id) — в SQLite это
+    # таблица WITHOUT ROWID, кластеризованная по первичному ключу.
+    __tablename__ = "grade_archive"
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    student_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # id из Grade — порядок вставки
+    subject_id = db.Column(db.Integer, nullable=False)
+    quarter = db.Column(db.SmallInteger, nullable=False)
+    week = db.Column(db.SmallInteger, nullable=True)
+    value = db.Column(db.SmallInteger, nullable=False)
+
+    __table_args__ = {"sqlite_with_rowid": False}
+
+class ArchivedYear(db.Model):
+    # Годы, оценки которых перенесены в GradeArchive
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    rows = db.Column(db.Integer, nullable=False, default=0)
+
+class QuarterMark(db.Model):
+    # Итоги закрытой четверти (см. close_quarter): неизменяемый снимок сумм
+    # и среднего по (ученик, год, предмет, четверть)
+    student_id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    subject_id = db.Column(db.Integer, primary_key=True)
+    quarter = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    total = db.Column(db.Integer, nullable=False)
+    average = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_quarter_mark_year", "year", "quarter", "subject_id"),
+    )
+
+class ClosedQuarter(db.Model):
+    # Закрытые четверти: их оценки не меняются, отчёты читают QuarterMark
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    quarter = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    rows = db.Column(db.Integer, nullable=False, default=0)
+
+class SchoolClass(db.Model):
+    # Класс (группа учеников), например «9А»
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(40), unique=True, nullable=False)
+
+class ClassStudent(db.Model):
+    # Состав класса
+    class_id = db.Column(db.Integer, db.ForeignKey('school_class.id'), primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+
+    __table_args__ = (db.Index("ix_class_student_student", "student_id"),)
+
+class TeachingAssignment(db.Model):
+    # Учитель ведёт предмет в классе
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    class_id = db.Column(db.Integer, db.ForeignKey('school_class.id'), primary_key=True)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), primary_key=True)
+
+    __table_args__ = (db.Index("ix_assignment_class", "class_id", "subject_id"),)
+
+class GradeRollup(db.Model):
+    # Материализованные суммы оценок по (ученик, год, предмет, четверть).
+    # Обновляются в той же транзакции, что и записи в Grade (см. upsert_grades).
+    student_id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    subject_id = db.Column(db.Integer, primary_key=True)
+    quarter = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index("ix_rollup_year_subject", "year", "subject_id", "quarter"),
+    )
+
+class GradeChange(db.Model):
+    # Журнал изменений оценок — только дописывается (см. log_grade_changes).
+    # seq растёт в порядке коммитов: записи оценок идут по одной (grade_writer)
+    seq = db.Column(db.Integer, primary_key=True)
+    op = db.Column(db.String(6), nullable=False)  # insert / update / delete
+    student_id = db.Column(db.Integer, nullable=False)
+    subject_id = db.Column(db.Integer, nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    quarter = db.Column(db.Integer, nullable=False)
+    week = db.Column(db.Integer, nullable=True)
+    value = db.Column(db.Integer, nullable=True)  # новое значение; у delete — NULL
+    old_value = db.Column(db.Integer, nullable=True)  # прежнее; у insert — NULL
+    changed_at = db.Column(db.DateTime, nullable=False)
+    actor_id = db.Column(db.Integer, nullable=True)  # кто менял; NULL — консоль
+
+class DataVersion(db.Model):
+    # Счётчик изменений данных для ETag API и проверки кэша отчётов:
+    # "grades:<год>", "grades:<год>:<четверть>", "student:<id>", "users"
+    scope = db.Column(db.String(40), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
 # ───────── Helpers ─────────
 def current_year():
     return datetime.now().year
@@ -49,6 +249,973 @@ def current_year():
 
 
 
+def avg_of(count, total, empty=0):
+    # Средний балл с тем же округлением, что и раньше (sum/len)
+    return round(total / count, 2) if count else empty
+
+
+# ───────── Aggregation ─────────
+def grade_aggregate_query(year, subject_id=0, quarters=None, week=0, student_id=0, students=None):
+    # (student_id, subject_id, count, total) одним GROUP BY.
+    # Без фильтра по неделе читаем готовые суммы: роллапы или снимок закрытых четвертей.
+    if week:
+        src = grade_table(year)
+        q = db.session.query(
+            src.student_id, src.subject_id,
+            func.count(src.id).label("count"), func.sum(src.value).label("total")
+        ).filter(src.week == week)
+    else:
+        src = mark_source(year, quarters).c
+        q = db.session.query(
+            src.student_id, src.subject_id,
+            func.sum(src.count).label("count"), func.sum(src.total).label("total")
+        )
+    q = q.filter(src.year == year)
+    if subject_id:
+        q = q.filter(src.subject_id == subject_id)
+    if quarters:
+        q = q.filter(src.quarter.in_(quarters))
+    if student_id:
+        q = q.filter(src.student_id == student_id)
+    if students is not None:
+        q = q.filter(src.student_id.in_(students))
+    return q.group_by(src.student_id, src.subject_id).order_by(src.student_id, src.subject_id)
+
+
+def grade_aggregates(year, subject_id=0, quarters=None, week=0, student_id=0, students=None):
+    # Один GROUP BY запрос вместо запроса на каждого ученика:
+    # {student_id: {subject_id: (count, sum)}}
+    q = grade_aggregate_query(year, subject_id, quarters, week, student_id, students)
+    result = {}
+    for student_id, subj_id, count, total in q:
+        result.setdefault(student_id, {})[subj_id] = (count, total)
+    return result
+
+
+def grade_values(year, subject_id=0, quarters=None, week=0, students=None):
+    # Списки оценок по ученикам одним запросом (порядок — как при вставке)
+    src = grade_table(year)
+    q = db.session.query(src.student_id, src.value).filter(src.year == year)
+    if students is not None:
+        q = q.filter(src.student_id.in_(students))
+    if subject_id:
+        q = q.filter(src.subject_id == subject_id)
+    if quarters:
+        q = q.filter(src.quarter.in_(quarters))
+    if week:
+        q = q.filter(src.week == week)
+
+    result = {}
+    for student_id, value in q.order_by(src.student_id, src.id):
+        result.setdefault(student_id, []).append(value)
+    return result
+
+
+def student_totals(subj_aggs):
+    # (count, sum) по всем предметам ученика
+    count = sum(c for c, _ in subj_aggs.values())
+    total = sum(t for _, t in subj_aggs.values())
+    return count, total
+
+
+# ───────── Grade writes ─────────
+GRADE_SLOT = ("student_id", "subject_id", "year", "quarter", "week")
+
+
+def chunked(seq, size=500):
+    # SQLite ограничивает число параметров в одном запросе
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def dialect_insert(model):
+    # INSERT ... ON CONFLICT DO UPDATE: одинаковый API в SQLite и PostgreSQL
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
+
+
+def parse_grade_form(form):
+    # Поля student_<id> → {student_id: value}; неверные значения считаем пропущенными
+    values, skipped = {}, 0
+    for key, raw in form.items():
+        if not key.startswith("student_"):
+            continue
+        raw = raw.strip()
+        if not raw:
+            continue
+        try:
+            student_id = int(key[len("student_"):])
+            value = int(raw)
+        except ValueError:
+            skipped += 1
+            continue
+        if value < 2 or value > 5:
+            skipped += 1
+            continue
+        values[student_id] = value
+    return values, skipped
+
+
+def upsert_grades(rows):
+    # Пакетная запись оценок: один SELECT текущих значений на ячейку журнала
+    # и один INSERT ... ON CONFLICT DO UPDATE на всю пачку.
+    # rows — список dict с ключами GRADE_SLOT + "value". Коммит — за вызывающим.
+    stats = {"inserted": 0, "updated": 0, "skipped": 0}
+
+    locked = locked_quarters()  # закрытые четверти и архив — только для чтения
+    slots = {}
+    for row in rows:
+        if (row["year"], row["quarter"]) in locked:
+            stats["skipped"] += 1
+            continue
+        key = (row["subject_id"], row["year"], row["quarter"], row["week"])
+        slots.setdefault(key, {})[row["student_id"]] = row["value"]
+
+    to_write, changes, deltas = [], [], {}
+    for (subject_id, year, quarter, week), values in slots.items():
+        existing = {}
+        for ids in chunked(list(values)):
+            existing.update(db.session.query(Grade.student_id, Grade.value).filter(
+                Grade.subject_id == subject_id, Grade.year == year,
+                Grade.quarter == quarter, Grade.week == week,
+                Grade.student_id.in_(ids)
+            ))
+        for student_id, value in values.items():
+            old = existing.get(student_id)
+            if old == value:
+                stats["skipped"] += 1
+                continue
+            stats["updated" if old is not None else "inserted"] += 1
+            to_write.append(dict(student_id=student_id, subject_id=subject_id, value=value,
+                                 year=year, quarter=quarter, week=week))
+            changes.append(dict(to_write[-1], op="update" if old is not None else "insert",
+                                old_value=old))
+            d = deltas.setdefault((student_id, year, subject_id, quarter), [0, 0])
+            d[0] += 0 if old is not None else 1
+            d[1] += value - (old or 0)
+
+    if to_write:
+        stmt = dialect_insert(Grade)
+        stmt = stmt.on_conflict_do_update(index_elements=list(GRADE_SLOT),
+                                          set_={"value": stmt.excluded.value})
+        for batch in chunked(to_write):
+            db.session.execute(stmt, batch)
+        log_grade_changes(changes)
+        apply_rollup_deltas(deltas)
+        bump_data_versions({f"grades:{year}" for _, year, _, _ in deltas}
+                           | {f"grades:{year}:{quarter}" for _, year, _, quarter in deltas}
+                           | {f"student:{student_id}" for student_id, _, _, _ in deltas})
+    return stats
+
+
+# ───────── Rollups ─────────
+ROLLUP_KEY = ("student_id", "year", "subject_id", "quarter")
+
+
+def apply_rollup_deltas(deltas):
+    # deltas: {(student_id, year, subject_id, quarter): [dcount, dtotal]}
+    rows = [dict(zip(ROLLUP_KEY, key), count=dc, total=dt) for key, (dc, dt) in deltas.items()]
+    if not rows:
+        return
+    stmt = dialect_insert(GradeRollup)
+    stmt = stmt.on_conflict_do_update(index_elements=list(ROLLUP_KEY), set_={
+        "count": GradeRollup.count + stmt.excluded.count,
+        "total": GradeRollup.total + stmt.excluded.total,
+    })
+    for batch in chunked(rows):
+        db.session.execute(stmt, batch)
+
+
+def rollup_select(src):
+    # Суммы по ключу роллапа для оценок существующих пользователей (Grade или архив)
+    return db.select(
+        src.student_id, src.year, src.subject_id, src.quarter,
+        func.count(src.id), func.sum(src.value)
+    ).where(src.student_id.in_(db.select(User.id))) \
+     .group_by(src.student_id, src.year, src.subject_id, src.quarter)
+
+
+def rollups_from_grades():
+    # Эталонный пересчёт: горячие и архивные оценки, сгруппированные по ключу роллапа
+    return {tuple(r[:4]): (r[4], r[5])
+            for src in GRADE_TABLES for r in db.session.execute(rollup_select(src))}
+
+
+def check_rollups():
+    # Сверка GradeRollup с Grade: список (ключ, в роллапе, по оценкам)
+    expected = rollups_from_grades()
+    actual = {
+        (r.student_id, r.year, r.subject_id, r.quarter): (r.count, r.total)
+        for r in GradeRollup.query.filter(GradeRollup.count > 0)
+    }
+    return [(key, actual.get(key), expected.get(key))
+            for key in sorted(set(expected) | set(actual))
+            if actual.get(key) != expected.get(key)]
+
+
+def rebuild_rollups():
+    # Полный пересчёт роллапов с нуля одним INSERT ... SELECT
+    GradeRollup.query.delete()
+    for src in GRADE_TABLES:
+        db.session.execute(GradeRollup.__table__.insert().from_select(
+            list(ROLLUP_KEY) + ["count", "total"], rollup_select(src)))
+    db.session.commit()
+    grade_matrices.clear()
+
+
+# ───────── Grade change log ─────────
+# Каждая вставка, правка и удаление оценки дописывается в GradeChange в той же
+# транзакции. Внешние системы забирают изменения страницами по seq
+# (/api/v1/grades/changes?after=N) вместо полной выгрузки журнала.
+CHANGES_PAGE_SIZE = int(os.environ.get("CHANGES_PAGE_SIZE", 1000))
+
+
+def change_actor():
+    return session.get("user_id") if has_request_context() else None
+
+
+def log_grade_changes(changes):
+    # changes — dict с ключами GRADE_SLOT + value, old_value, op. Коммит — за вызывающим
+    now, actor = datetime.now(), change_actor()
+    rows = [dict(row, changed_at=now, actor_id=actor) for row in changes]
+    for batch in chunked(rows):
+        db.session.execute(db.insert(GradeChange), batch)
+
+
+def log_grade_deletes(src, condition):
+    # Удаления — одним INSERT ... SELECT по тем же строкам, до самого DELETE
+    columns = list(GRADE_SLOT) + ["old_value", "value", "op", "changed_at", "actor_id"]
+    db.session.execute(GradeChange.__table__.insert().from_select(columns, db.select(
+        src.student_id, src.subject_id, src.year, src.quarter, src.week, src.value,
+        db.null(), db.literal("delete"), db.literal(datetime.now(), db.DateTime),
+        db.literal(change_actor(), db.Integer),
+    ).where(condition).order_by(src.id)))
+
+
+def latest_change_seq():
+    return db.session.query(func.coalesce(func.max(GradeChange.seq), 0)).scalar()
+
+
+def change_deltas(year, after, upto):
+    # Изменения года с seq в (after, upto] как дельты роллапов:
+    # {(student_id, year, subject_id, quarter): [dcount, dtotal]}
+    deltas = {}
+    rows = db.session.query(GradeChange.student_id, GradeChange.subject_id, GradeChange.quarter,
+                            GradeChange.op, GradeChange.value, GradeChange.old_value) \
+        .filter(GradeChange.seq > after, GradeChange.seq <= upto, GradeChange.year == year)
+    for student_id, subject_id, quarter, op, value, old in rows:
+        d = deltas.setdefault((student_id, year, subject_id, quarter), [0, 0])
+        d[0] += {"insert": 1, "delete": -1}.get(op, 0)
+        d[1] += (value or 0) - (old or 0)
+    return deltas
+
+
+def grade_changes_since(after, limit):
+    # Страница журнала после seq=after: (изменения, есть ли ещё)
+    rows = db.session.query(GradeChange, User.username) \
+        .outerjoin(User, User.id == GradeChange.student_id) \
+        .filter(GradeChange.seq > after).order_by(GradeChange.seq).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
+# ───────── Grade archive ─────────
+# Закрытые годы переезжают из Grade в GradeArchive: горячая таблица и её
+# индексы не растут с каждым годом. Роллапы года остаются на месте, а
+# запросы к оценкам выбирают таблицу по году (grade_table), так что отчёты
+# и выгрузки с ?year= читают архив незаметно для вызывающего.
+GRADE_TABLES = (Grade, GradeArchive)
+ARCHIVE_COLUMNS = ("year", "student_id", "id", "subject_id", "quarter", "week", "value")
+
+
+def per_request(name, load):
+    # Значение читается из БД один раз за запрос (вне запроса — при каждом
+    # вызове): изменение из другого процесса видно со следующего запроса
+    if not has_request_context():
+        return load()
+    if name not in g:
+        setattr(g, name, load())
+    return g.get(name)
+
+
+def forget(name):
+    if has_request_context():
+        g.pop(name, None)
+
+
+def archived_years():
+    return per_request("archived_years",
+                       lambda: {year for (year,) in db.session.query(ArchivedYear.year)})
+
+
+def grade_table(year):
+    return GradeArchive if year in archived_years() else Grade
+
+
+def move_grades(year, src, dst):
+    # INSERT ... SELECT + DELETE одной транзакцией; оценки удалённых
+    # пользователей при переносе отбрасываются. При возврате в Grade id выдаёт
+    # база (в прежнем порядке): без AUTOINCREMENT SQLite мог отдать старые id
+    # новым оценкам
+    columns = ARCHIVE_COLUMNS if dst is GradeArchive else [c for c in ARCHIVE_COLUMNS if c != "id"]
+    moved = db.session.execute(dst.__table__.insert().from_select(
+        columns,
+        db.select(*[getattr(src, c) for c in columns])
+        .where(src.year == year, src.student_id.in_(db.select(User.id)))
+        .order_by(src.id)
+    )).rowcount
+    db.session.execute(db.delete(src).where(src.year == year))
+    return moved
+
+
+def archive_year(year):
+    if year >= current_year():
+        raise ValueError(f"{year}: архивировать можно только закрытые годы")
+    if year in archived_years():
+        raise ValueError(f"{year}: год уже в архиве")
+    with grade_writer():
+        moved = move_grades(year, Grade, GradeArchive)
+        db.session.add(ArchivedYear(year=year, rows=moved))
+        db.session.commit()
+    forget("archived_years")
+    return moved
+
+
+def restore_year(year):
+    # Обратный перенос — например, чтобы исправить оценки закрытого года
+    if year not in archived_years():
+        raise ValueError(f"{year}: года нет в архиве")
+    with grade_writer():
+        moved = move_grades(year, GradeArchive, Grade)
+        ArchivedYear.query.filter_by(year=year).delete()
+        db.session.commit()
+    forget("archived_years")
+    return moved
+
+
+# ───────── Quarter close ─────────
+# Закрытие четверти один раз переносит её итоги из роллапов в QuarterMark.
+# Дальше суммы закрытых четвертей читаются из снимка (mark_source), а запись
+# оценок в них отклоняется (locked_quarters) до явного reopen_quarter.
+def closed_quarters():
+    return per_request("closed_quarters", lambda: set(
+        db.session.query(ClosedQuarter.year, ClosedQuarter.quarter).tuples()))
+
+
+def locked_quarters():
+    # (год, четверть), в которые нельзя писать: закрытые четверти и архивные годы
+    return closed_quarters() | {(year, q) for year in archived_years() for q in range(1, 5)}
+
+
+def mark_source(year, quarters=None):
+    # Подзапрос (student_id, year, subject_id, quarter, count, total) за четверти года:
+    # закрытые — из снимка QuarterMark, открытые — из GradeRollup
+    quarters = set(quarters or (1, 2, 3, 4))
+    closed = {q for y, q in closed_quarters() if y == year} & quarters
+    parts = []
+    if closed:
+        parts.append(db.select(
+            QuarterMark.student_id, QuarterMark.year, QuarterMark.subject_id, QuarterMark.quarter,
+            QuarterMark.count, QuarterMark.total
+        ).where(QuarterMark.year == year, QuarterMark.quarter.in_(sorted(closed))))
+    if quarters - closed or not parts:
+        parts.append(db.select(
+            GradeRollup.student_id, GradeRollup.year, GradeRollup.subject_id, GradeRollup.quarter,
+            GradeRollup.count, GradeRollup.total
+        ).where(GradeRollup.year == year, GradeRollup.quarter.in_(sorted(quarters - closed)),
+                GradeRollup.count > 0))
+    return (parts[0] if len(parts) == 1 else db.union_all(*parts)).subquery()
+
+
+def check_quarter(quarter):
+    if not 1 <= quarter <= 4:
+        raise ValueError(f"Четверть должна быть от 1 до 4, а не {quarter}")
+
+
+def close_quarter(year, quarter):
+    check_quarter(quarter)
+    if (year, quarter) in closed_quarters():
+        raise ValueError(f"{quarter} четверть {year} года уже закрыта")
+    with grade_writer():
+        rows = [dict(student_id=student_id, year=year, subject_id=subject_id, quarter=quarter,
+                     count=count, total=total, average=avg_of(count, total))
+                for student_id, subject_id, count, total in db.session.execute(db.select(
+                    GradeRollup.student_id, GradeRollup.subject_id, GradeRollup.count, GradeRollup.total
+                ).where(GradeRollup.year == year, GradeRollup.quarter == quarter, GradeRollup.count > 0,
+                        GradeRollup.student_id.in_(db.select(User.id))))]
+        for batch in chunked(rows):
+            db.session.execute(db.insert(QuarterMark), batch)
+        db.session.add(ClosedQuarter(year=year, quarter=quarter, rows=len(rows)))
+        db.session.commit()
+    forget("closed_quarters")
+    return len(rows)
+
+
+def reopen_quarter(year, quarter):
+    # Снимок удаляется: отчёты снова читают роллапы, оценки можно править
+    check_quarter(quarter)
+    if (year, quarter) not in closed_quarters():
+        raise ValueError(f"{quarter} четверть {year} года не закрыта")
+    with grade_writer():
+        QuarterMark.query.filter_by(year=year, quarter=quarter).delete()
+        ClosedQuarter.query.filter_by(year=year, quarter=quarter).delete()
+        db.session.commit()
+    forget("closed_quarters")
+
+
+# ───────── Pagination ─────────
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 50))
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        return None
+
+
+def cursor_matches(cursor, types):
+    # Курсор из адреса — любой JSON: проверяем, что это список нужных типов
+    return (isinstance(cursor, list) and len(cursor) == len(types)
+            and all(isinstance(v, t) and not isinstance(v, bool) for v, t in zip(cursor, types)))
+
+
+def filter_users(query, search="", role=""):
+    # Поиск по логину или ФИО (подстрока) и фильтр по роли
+    if search:
+        like = "%" + re.sub(r"([\\%_])", r"\\\1", search) + "%"
+        query = query.filter(or_(User.username.ilike(like, escape="\\"),
+                                 User.fullname.ilike(like, escape="\\")))
+    if role:
+        query = query.filter(User.role == role)
+    return query
+
+
+def keyset_page(query, order="id", after=None, limit=None):
+    # Постраничная выборка «с места»: вместо OFFSET продолжаем после последней
+    # строки предыдущей страницы, поэтому каждая страница — один проход по индексу.
+    # Возвращает (строки, курсор следующей страницы или None).
+    limit = limit or PAGE_SIZE
+    cursor = decode_cursor(after) if after else None
+    # Испорченный или чужой курсор — показываем первую страницу
+    if not cursor_matches(cursor, (str, int) if order == "name" else (int,)):
+        cursor = None
+    if order == "name":
+        query = query.order_by(USER_DISPLAY_NAME, User.id)
+        if cursor:
+            name, last_id = cursor
+            query = query.filter(or_(USER_DISPLAY_NAME > name,
+                                     and_(USER_DISPLAY_NAME == name, User.id > last_id)))
+    else:
+        query = query.order_by(User.id)
+        if cursor:
+            query = query.filter(User.id > cursor[0])
+
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    if order == "name":
+        return rows, encode_cursor([last.fullname or last.username, last.id])
+    return rows, encode_cursor([last.id])
+
+
+def page_args(*names):
+    # Текущие параметры запроса для ссылок «далее»/«в начало»
+    return {n: request.values[n] for n in names if request.values.get(n)}
+
+
+# ───────── Classes ─────────
+# Учитель работает только со своими классами. Пока в школе не заведено ни
+# одного класса, действует старое поведение — вся школа.
+def classes_configured():
+    return db.session.query(SchoolClass.id).first() is not None
+
+
+def teacher_student_ids(teacher_id, class_id=0, subject_id=0):
+    # Подзапрос id учеников из классов учителя (None — без ограничения)
+    if teacher_id is None or not classes_configured():
+        return None
+    q = db.select(ClassStudent.student_id).join(
+        TeachingAssignment, TeachingAssignment.class_id == ClassStudent.class_id
+    ).where(TeachingAssignment.teacher_id == teacher_id)
+    if class_id:
+        q = q.where(ClassStudent.class_id == class_id)
+    if subject_id:
+        q = q.where(TeachingAssignment.subject_id == subject_id)
+    return q
+
+
+def scoped_students(teacher_id=None, class_id=0, subject_id=0):
+    q = User.query.filter_by(role="student")
+    ids = teacher_student_ids(teacher_id, class_id, subject_id)
+    if ids is not None:
+        q = q.filter(User.id.in_(ids))
+    return q
+
+
+def teacher_subjects(teacher_id):
+    q = Subject.query
+    if classes_configured():
+        q = q.filter(Subject.id.in_(db.select(TeachingAssignment.subject_id)
+                                    .where(TeachingAssignment.teacher_id == teacher_id)))
+    return q.order_by(Subject.id).all()
+
+
+def teacher_classes(teacher_id):
+    return SchoolClass.query.filter(SchoolClass.id.in_(
+        db.select(TeachingAssignment.class_id).where(TeachingAssignment.teacher_id == teacher_id)
+    )).order_by(SchoolClass.name).all()
+
+
+def request_teacher_id():
+    # Ограничение по классам действует для учителя; админ видит всю школу
+    user = current_user()
+    return user.id if user and user.role == "teacher" else None
+
+
+# ───────── Report cache ─────────
+# Ключ кэша отчётов. scope — id ученика для student_report,
+# (учитель, класс) для teacher_report, 0 для школьных отчётов.
+ReportKey = namedtuple("ReportKey", "endpoint year period subject scope")
+
+
+def period_quarters(period):
+    # quarter1..4, halfyear1/2, year → список четвертей
+    if period.startswith("quarter"):
+        return [int(period[-1])]
+    if period == "halfyear1":
+        return [1, 2]
+    if period == "halfyear2":
+        return [3, 4]
+    return [1, 2, 3, 4]
+
+
+class ReportCache(abc.ABC):
+    # Интерфейс бэкенда: сюда же можно подключить shared-memory или файловый кэш.
+    # Неполный бэкенд не создаётся (TypeError), а не падает на первом обращении
+    @abc.abstractmethod
+    def get(self, key):
+        ...
+
+    @abc.abstractmethod
+    def set(self, key, value, generation=None):
+        # generation — значение self.generation до вычисления value: если с тех
+        # пор был сброс, значение могло устареть и не сохраняется
+        ...
+
+    @abc.abstractmethod
+    def invalidate(self, match):
+        # Удаляет все записи, для которых match(key) истинно; возвращает их число.
+        # Каждый вызов увеличивает self.generation
+        ...
+
+    @abc.abstractmethod
+    def stats(self):
+        ...
+
+
+class MemoryReportCache(ReportCache):
+    # LRU в памяти процесса с ограничением по числу записей
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self.generation = self.skipped = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                self.skipped += 1
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, match):
+        with self._lock:
+            self.generation += 1
+            stale = [key for key in self._data if match(key)]
+            for key in stale:
+                del self._data[key]
+            self.invalidations += len(stale)
+            return len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "max_size": self.max_size,
+                    "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "invalidations": self.invalidations,
+                    "skipped": self.skipped}
+
+
+report_cache = MemoryReportCache(int(os.environ.get("REPORT_CACHE_SIZE", 256)))
+
+
+def report_scopes(key):
+    # Версии данных (см. DataVersion), из которых собран отчёт
+    if key.endpoint == "student_report":
+        return [f"student:{key.scope}"]
+    # Динамика аналитики охватывает все четверти при любом периоде
+    quarters = (1, 2, 3, 4) if key.endpoint == "admin_analytics" else period_quarters(key.period)
+    return [f"grades:{key.year}:{q}" for q in quarters] + ["users"]
+
+
+def cached_report(key, compute):
+    # Кэш — в памяти процесса, а записи бывают и в других (воркеры gunicorn,
+    # консольный импорт). Поэтому с отчётом храним версии его данных, прочитанные
+    # до вычисления: не совпали с текущими в БД — это промах
+    versions = data_versions(report_scopes(key))
+    entry = report_cache.get(key)
+    if entry is not None and entry[0] == versions:
+        return entry[1]
+    # Запись, закоммиченная во время вычисления, сбросит кэш — тогда результат не кладём
+    generation = report_cache.generation
+    value = compute()
+    report_cache.set(key, (versions, value), generation)
+    return value
+
+
+def invalidate_grade_reports(year, quarter, subject_id, student_ids):
+    # Сбрасываем только отчёты, в которые попадают изменённые оценки
+    student_ids = set(student_ids)
+
+    def covers(key):
+        if key.endpoint == "admin_analytics":
+            return key.year == year  # динамика по четвертям есть в отчёте любого периода
+        return (key.year == year
+                and quarter in period_quarters(key.period)
+                and key.subject in (0, subject_id)
+                and (key.endpoint != "student_report" or key.scope in student_ids))
+    return invalidate_reports(covers)
+
+
+def invalidate_user_reports(user_id):
+    # ФИО и состав учеников видны во всех классных/школьных отчётах любого года
+    bump_data_versions(["users"])
+    db.session.commit()
+    return invalidate_reports(
+        lambda key: key.endpoint != "student_report" or key.scope == user_id)
+
+
+def invalidate_class_reports():
+    # Состав классов и назначения учителей меняют только классные отчёты
+    bump_data_versions(["users"])
+    db.session.commit()
+    invalidate_fragments("subjects")  # назначения учителей меняют их списки предметов
+    return invalidate_reports(lambda key: key.endpoint == "teacher_report")
+
+
+def invalidate_reports(match):
+    # Вместе с данными отчётов сбрасываем отрендеренные из них таблицы
+    fragment_cache.invalidate(lambda key: key.report is not None and match(key.report))
+    return report_cache.invalidate(match)
+
+
+# ───────── Template fragments ─────────
+# Готовый HTML редко меняющихся блоков шаблона:
+#   {% call cached_fragment("имя", аргументы..., report=ключ) %}…{% endcall %}
+# Фрагмент с report=ReportKey сбрасывается вместе с данными этого отчёта,
+# остальные — явно через invalidate_fragments(имя). Как и отчёты, фрагменты
+# хранятся с версиями своих данных (report_scopes или FRAGMENT_SCOPES), поэтому
+# изменения из других процессов тоже видны сразу.
+FragmentKey = namedtuple("FragmentKey", "name args report")
+fragment_cache = MemoryReportCache(int(os.environ.get("FRAGMENT_CACHE_SIZE", 512)))
+FRAGMENT_SCOPES = {"subjects": ["users"]}  # предметы учителя — из назначений по классам
+
+
+@app.template_global()
+def cached_fragment(name, *args, report=None, caller):
+    key = FragmentKey(name, args, report)
+    scopes = report_scopes(report) if report else FRAGMENT_SCOPES.get(name, [])
+    versions = data_versions(scopes) if scopes else []
+    entry = fragment_cache.get(key)
+    if entry is not None and entry[0] == versions:
+        return entry[1]
+    generation = fragment_cache.generation
+    html = caller()
+    fragment_cache.set(key, (versions, html), generation)
+    return html
+
+
+def invalidate_fragments(*names):
+    return fragment_cache.invalidate(lambda key: key.name in names)
+
+
+# ───────── Static files ─────────
+# В URL статики — хеш содержимого (?v=…): такой ответ можно кэшировать
+# в браузере «навсегда», после изменения файла у него будет новый URL.
+STATIC_MAX_AGE = 365 * 24 * 3600
+static_hashes = {}  # имя файла → (mtime, хеш)
+
+
+def static_hash(filename):
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    mtime = os.stat(path).st_mtime_ns
+    cached = static_hashes.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(path, "rb") as f:
+            cached = (mtime, hashlib.sha1(f.read()).hexdigest()[:12])
+        static_hashes[filename] = cached
+    return cached[1]
+
+
+@app.url_defaults
+def static_fingerprint(endpoint, values):
+    if endpoint == "static" and "v" not in values:
+        digest = static_hash(values.get("filename", ""))
+        if digest:
+            values["v"] = digest
+
+
+@app.after_request
+def static_cache_headers(response):
+    # Старый хеш (файл уже поменялся) отдаём как обычно, без immutable
+    if (request.endpoint == "static" and response.status_code == 200
+            and request.args.get("v") == static_hash(request.view_args["filename"])):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
+# ───────── Data versions ─────────
+# Версии хранятся в БД и растут в той же транзакции, что и сами изменения,
+# поэтому все воркеры выдают один и тот же ETag для одних и тех же данных.
+def bump_data_versions(scopes):
+    rows = [{"scope": scope, "version": 1} for scope in sorted(scopes)]
+    if not rows:
+        return
+    stmt = dialect_insert(DataVersion)
+    stmt = stmt.on_conflict_do_update(index_elements=["scope"],
+                                      set_={"version": DataVersion.version + 1})
+    for batch in chunked(rows):
+        db.session.execute(stmt, batch)
+
+
+def data_versions(scopes):
+    versions = dict(db.session.query(DataVersion.scope, DataVersion.version)
+                    .filter(DataVersion.scope.in_(scopes)))
+    return [versions.get(scope, 0) for scope in scopes]
+
+
+# ───────── Grade matrix ─────────
+# Оценки года в памяти: четверти × ученики × предметы, два плотных массива
+# numpy (число оценок и сумма). Строится одним запросом к GradeRollup, дальше
+# аналитика — векторные операции над массивами, без обхода словарей. Матрица
+# помнит seq журнала изменений (GradeChange), на котором прочитана, и перед
+# выдачей догоняет журнал — так видны записи любого процесса (воркеры gunicorn,
+# консольный импорт), а не только своего.
+GRADE_MATRIX_YEARS = int(os.environ.get("GRADE_MATRIX_YEARS", 2))
+# Изменения в обход журнала (gendata, rebuild, правка БД вручную) матрица увидит
+# только после перезагрузки: раз в столько секунд. 0 — без ограничения возраста.
+GRADE_MATRIX_MAX_AGE = int(os.environ.get("GRADE_MATRIX_MAX_AGE", 0))  # секунды
+# Больше изменений с момента загрузки — дешевле перечитать матрицу целиком
+GRADE_MATRIX_CATCHUP = int(os.environ.get("GRADE_MATRIX_CATCHUP", 50000))
+RISK_THRESHOLD = 3.0
+
+
+class GradeMatrix:
+    def __init__(self, year, student_ids, subject_ids):
+        self.year = year
+        self.student_ids = np.asarray(student_ids, dtype=np.int64)  # по возрастанию id
+        self.subject_ids = np.asarray(subject_ids, dtype=np.int64)
+        self.index = {sid: i for i, sid in enumerate(student_ids)}
+        self.subject_index = {sid: j for j, sid in enumerate(subject_ids)}
+        shape = (4, len(student_ids), len(subject_ids))
+        self.counts = np.zeros(shape, dtype=np.int32)
+        self.totals = np.zeros(shape, dtype=np.int32)
+        self.loaded = time.time()
+        self.seq = 0  # последнее изменение из GradeChange, учтённое в матрице
+        self.load_ms = 0.0
+
+    @classmethod
+    def load(cls, year):
+        started = time.perf_counter()
+        students = [uid for (uid,) in db.session.query(User.id).filter_by(role="student").order_by(User.id)]
+        subjects = [sid for (sid,) in db.session.query(Subject.id).order_by(Subject.id)]
+        m = cls(year, students, subjects)
+        m.seq = latest_change_seq()  # на случай, если роллапов года ещё нет
+        src = mark_source(year).c
+        # seq журнала — колонкой того же SELECT: один запрос видит один снимок БД,
+        # так что матрица ровно соответствует seq (отдельный запрос мог бы разойтись)
+        latest = db.select(func.coalesce(func.max(GradeChange.seq), 0)).scalar_subquery()
+        rows = db.session.execute(db.select(src.student_id, src.subject_id, src.quarter,
+                                            src.count, src.total, latest))
+        # fromiter по плоскому потоку значений в разы быстрее np.array по строкам
+        data = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64).reshape(-1, 6)
+        if len(data):
+            m.seq = int(data[0, 5])
+        if len(data) and students and subjects:
+            si = np.searchsorted(m.student_ids, data[:, 0]).clip(0, len(students) - 1)
+            sj = np.searchsorted(m.subject_ids, data[:, 1]).clip(0, len(subjects) - 1)
+            q = data[:, 2] - 1
+            # Роллапы бывших учеников, удалённых предметов и четвертей вне 1..4 пропускаем
+            ok = ((m.student_ids[si] == data[:, 0]) & (m.subject_ids[sj] == data[:, 1])
+                  & (q >= 0) & (q < 4))
+            m.counts[q[ok], si[ok], sj[ok]] = data[ok, 3]
+            m.totals[q[ok], si[ok], sj[ok]] = data[ok, 4]
+        m.load_ms = (time.perf_counter() - started) * 1000
+        return m
+
+    def apply(self, deltas):
+        # deltas: {(student_id, year, subject_id, quarter): [dcount, dtotal]}.
+        # False — в дельтах есть ученик или предмет, которого нет в матрице.
+        for (student_id, year, subject_id, quarter), (dc, dt) in deltas.items():
+            if year != self.year:
+                continue
+            i, j = self.index.get(student_id), self.subject_index.get(subject_id)
+            if i is None or j is None or not 1 <= quarter <= 4:
+                return False
+            self.counts[quarter - 1, i, j] += dc
+            self.totals[quarter - 1, i, j] += dt
+        return True
+
+    def sums(self, quarters=None):
+        # (count, sum) по ученикам × предметам за выбранные четверти
+        sel = sorted({q - 1 for q in quarters or (1, 2, 3, 4) if 1 <= q <= 4})
+        if sel == [0, 1, 2, 3]:
+            return self.counts.sum(axis=0), self.totals.sum(axis=0)
+        return self.counts[sel].sum(axis=0), self.totals[sel].sum(axis=0)
+
+    def student_averages(self, quarters=None, subject_id=0):
+        # Средний балл каждого ученика (NaN — оценок нет)
+        counts, totals = self.sums(quarters)
+        if subject_id:
+            j = self.subject_index.get(subject_id)
+            if j is None:
+                return np.full(len(self.student_ids), np.nan)
+            counts, totals = counts[:, j], totals[:, j]
+        else:
+            counts, totals = counts.sum(axis=1), totals.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, totals / counts, np.nan)
+
+    def subject_averages(self, quarters=None):
+        counts, totals = self.sums(quarters)
+        counts, totals = counts.sum(axis=0), totals.sum(axis=0)
+        return {int(sid): avg_of(int(c), int(t))
+                for sid, c, t in zip(self.subject_ids, counts, totals)}
+
+    def distribution(self, quarters=None, subject_id=0, bins=(2, 2.5, 3, 3.5, 4, 4.5, 5.01)):
+        # Гистограмма средних баллов учеников: [(от, до, число учеников)]
+        avgs = self.student_averages(quarters, subject_id)
+        hist, edges = np.histogram(avgs[~np.isnan(avgs)], bins=bins)
+        return [(float(edges[k]), min(5.0, float(edges[k + 1])), int(n)) for k, n in enumerate(hist)]
+
+    def percentiles(self, quarters=None, subject_id=0):
+        # Процентильный ранг: доля учеников с меньшим средним (0..100), NaN — нет оценок
+        avgs = self.student_averages(quarters, subject_id)
+        graded = ~np.isnan(avgs)
+        ranks = np.full(len(avgs), np.nan)
+        if graded.any():
+            values = np.sort(avgs[graded])
+            ranks[graded] = np.searchsorted(values, avgs[graded], side="left") * 100.0 / len(values)
+        return ranks
+
+    def at_risk(self, quarters=None, threshold=RISK_THRESHOLD):
+        # [(student_id, средний)] учеников со средним ниже порога — худшие первыми
+        avgs = self.student_averages(quarters)
+        idx = np.flatnonzero(avgs < threshold)
+        idx = idx[np.argsort(avgs[idx], kind="stable")]
+        return [(int(self.student_ids[i]), round(float(avgs[i]), 2)) for i in idx]
+
+    def nbytes(self):
+        return self.counts.nbytes + self.totals.nbytes + self.student_ids.nbytes + self.subject_ids.nbytes
+
+
+class GradeMatrixStore:
+    # Матрицы последних запрошенных лет (LRU по GRADE_MATRIX_YEARS)
+    def __init__(self, max_years=2, max_age=0):
+        self.max_years = max_years
+        self.max_age = max_age
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.loads = self.updates = self.drops = 0
+
+    def get(self, year):
+        with self._lock:
+            m = self._data.get(year)
+            if m is not None and self.max_age and time.time() - m.loaded > self.max_age:
+                m = None
+            if m is not None:
+                self._data.move_to_end(year)
+        if m is not None:
+            m = self.catch_up(m)
+            if m is not None:
+                return m
+        # Загрузка идёт секунды — без блокировки: запросы к другим годам её не ждут
+        m = GradeMatrix.load(year)
+        with self._lock:
+            self.loads += 1
+            current = self._data.get(year)
+            if current is None or current.seq <= m.seq:
+                self._data[year] = m
+                while len(self._data) > self.max_years:
+                    self._data.popitem(last=False)
+            return m
+
+    def catch_up(self, m):
+        # Дописывает в матрицу изменения журнала после m.seq. None — матрицу
+        # проще перечитать (много изменений, новый ученик или предмет)
+        start, latest = m.seq, latest_change_seq()
+        if latest <= start:
+            return m
+        deltas = change_deltas(m.year, start, latest) if latest - start <= GRADE_MATRIX_CATCHUP else None
+        with self._lock:
+            if m.seq != start:
+                # Другой поток уже догнал или догоняет эту матрицу
+                return m if m.seq >= latest else None
+            if deltas is not None and m.apply(deltas):
+                m.seq = latest
+                self.updates += 1
+                return m
+            if self._data.get(m.year) is m:
+                del self._data[m.year]
+                self.drops += 1
+            return None
+
+    def clear(self):
+        with self._lock:
+            self.drops += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            years = {str(y): {"students": len(m.student_ids), "subjects": len(m.subject_ids),
+                              "bytes": m.nbytes(), "load_ms": round(m.load_ms, 2),
+                              "age_s": round(time.time() - m.loaded), "seq": m.seq}
+                     for y, m in self._data.items()}
+        return {"max_years": self.max_years, "max_age": self.max_age, "loads": self.loads,
+                "updates": self.updates, "drops": self.drops, "years": years}
+
+
+grade_matrices = GradeMatrixStore(GRADE_MATRIX_YEARS, GRADE_MATRIX_MAX_AGE)
+
+
 # Позволяет вызывать {{ current_year() }} прямо в шаблонах
 @app.context_processor
 def inject_globals():
@@ -68,9 +1235,9 @@ def create_demo_data():
     db.session.commit()
 
     # Пользователи
-    admin = User(username="admin", password_hash=generate_password_hash("admin123"),
+    admin = User(username="admin", password_hash=hash_password("admin123"),
                  role="admin", fullname="Администратор Школы")
-    teacher = User(username="teacher", password_hash=generate_password_hash("teach123"),
+    teacher = User(username="teacher", password_hash=hash_password("teach123"),
                    role="teacher", fullname="Иван Иванов (Учитель)")
 
     students = []
@@ -98,7 +1265,7 @@ def create_demo_data():
 
         u = User(
             username=f"student{i}",
-            password_hash=generate_password_hash("stud123"),
+            password_hash=hash_password("stud123"),
             role="student",
             fullname=f"Ученик {i} ({prof})"
         )
@@ -108,6 +1275,15 @@ def create_demo_data():
     db.session.add_all([admin, teacher])
     db.session.commit()
 
+    # Класс со всеми учениками; учитель ведёт в нём все три предмета
+    cls = SchoolClass(name="9А")
+    db.session.add(cls)
+    db.session.commit()
+    db.session.add_all([ClassStudent(class_id=cls.id, student_id=u.id) for u, _ in students])
+    db.session.add_all([TeachingAssignment(teacher_id=teacher.id, class_id=cls.id, subject_id=subj.id)
+                        for subj in [s1, s2, s3]])
+    db.session.commit()
+
     # Добавляем оценки
     for u, pattern in students:
         for subj in [s1, s2, s3]:
@@ -116,15 +1292,432 @@ def create_demo_data():
                           year=current_year(), quarter=q)
                 db.session.add(g)
     db.session.commit()
+    rebuild_rollups()
 
     print("Demo data created! Users:")
     print("  admin/admin123, teacher/teach123, student1..30/stud123")
 
 
+def create_large_data(students=2000, subjects=10, years=1, weeks=10, class_size=30, seed=1):
+    # Синтетическая «большая школа» для бенчмарков: миллионы оценок за минуты.
+    # Пишем пачками через Core без ORM-объектов, хеш пароля считаем один раз на роль.
+    import random
+    rnd = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+
+    names = ["Русский", "Математика", "Физика"] + [f"Предмет {i}" for i in range(4, subjects + 1)]
+    db.session.execute(db.insert(Subject), [{"name": n} for n in names[:subjects]])
+    subject_ids = [sid for (sid,) in db.session.query(Subject.id).order_by(Subject.id)]
+
+    admin_hash, teacher_hash, student_hash = (hash_password(p) for p in ("admin123", "teach123", "stud123"))
+    users = [{"username": "admin", "password_hash": admin_hash, "role": "admin",
+              "fullname": "Администратор Школы"}]
+    # teacher ведёт первый предмет, teacher2.. — остальные, каждый во всех классах
+    users += [{"username": "teacher" if i == 1 else f"teacher{i}", "password_hash": teacher_hash,
+               "role": "teacher", "fullname": f"Учитель {i}"} for i in range(1, subjects + 1)]
+    users += [{"username": f"student{i}", "password_hash": student_hash, "role": "student",
+               "fullname": f"Ученик {i}"} for i in range(1, students + 1)]
+    for chunk in chunked(users, 5000):
+        db.session.execute(db.insert(User), chunk)
+    teacher_ids = [uid for (uid,) in db.session.query(User.id).filter_by(role="teacher").order_by(User.id)]
+    student_ids = [uid for (uid,) in db.session.query(User.id).filter_by(role="student").order_by(User.id)]
+
+    class_count = max(1, -(-students // class_size))
+    db.session.execute(db.insert(SchoolClass), [{"name": f"Класс {i}"} for i in range(1, class_count + 1)])
+    class_ids = [cid for (cid,) in db.session.query(SchoolClass.id).order_by(SchoolClass.id)]
+    for chunk in chunked([{"class_id": class_ids[i // class_size], "student_id": sid}
+                          for i, sid in enumerate(student_ids)], 5000):
+        db.session.execute(db.insert(ClassStudent), chunk)
+    db.session.execute(db.insert(TeachingAssignment), [
+        {"teacher_id": tid, "class_id": cid, "subject_id": subj}
+        for tid, subj in zip(teacher_ids, subject_ids) for cid in class_ids])
+
+    # У каждого ученика свой «уровень» — средние получаются разными
+    first_year = current_year() - years + 1
+    batch, total = [], 0
+    for sid in student_ids:
+        level = rnd.uniform(2.5, 5.0)
+        for year in range(first_year, first_year + years):
+            for subj in subject_ids:
+                for quarter in range(1, 5):
+                    for week in range(1, weeks + 1):
+                        value = min(5, max(2, round(level + rnd.uniform(-1, 1))))
+                        batch.append({"student_id": sid, "subject_id": subj, "value": value,
+                                      "year": year, "quarter": quarter, "week": week})
+        if len(batch) >= 20000:
+            db.session.execute(db.insert(Grade), batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(Grade), batch)
+        total += len(batch)
+    db.session.commit()
+    rebuild_rollups()
+
+    print(f"Large data created: {students} students, {subjects} subjects, "
+          f"{class_count} classes, {total} grades")
+    print("  admin/admin123, teacher..teacher{}/teach123, student1..{}/stud123".format(subjects, students))
+
+
+# ───────── Migrations ─────────
+def dedupe_grades():
+    # Перед созданием uq_grade_slot: оставляем последнюю оценку в каждой ячейке.
+    # Оценки без недели не трогаем — NULL в уникальном индексе не конфликтует.
+    # Возвращает число удалённых строк.
+    deleted = db.session.execute(db.text("""
+        DELETE FROM grade
+        WHERE week IS NOT NULL AND id NOT IN (
+            SELECT MAX(id) FROM grade WHERE week IS NOT NULL
+            GROUP BY student_id, subject_id, year, quarter, week
+        )
+    """)).rowcount
+    db.session.commit()
+    return deleted
+
+
+def existing_index_names(table_name):
+    # Инспектор SQLAlchemy не видит индексы по выражениям в SQLite — читаем sqlite_master
+    if db.engine.dialect.name == "sqlite":
+        rows = db.session.execute(db.text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :t"), {"t": table_name})
+        return {name for (name,) in rows}
+    return {ix["name"] for ix in db.inspect(db.engine).get_indexes(table_name)}
+
+
+def migrate_db():
+    # db.create_all() не меняет существующие таблицы — недостающие индексы
+    # добавляем на месте, чтобы старые instance/data.db получили их без пересоздания
+    had_rollups = db.inspect(db.engine).has_table(GradeRollup.__tablename__)
+    db.create_all()
+    created, deduped = [], 0
+    for table in db.metadata.sorted_tables:
+        existing = existing_index_names(table.name)
+        for ix in table.indexes:
+            if ix.name in existing:
+                continue
+            if ix.unique and table is Grade.__table__:
+                deduped += dedupe_grades()
+            ix.create(db.engine)
+            created.append(ix.name)
+    # Роллапы считаем после чистки дублей — иначе в них останутся удалённые оценки
+    if not had_rollups or deduped:
+        rebuild_rollups()
+    return created
+
+
+# ───────── Passwords ─────────
+# Параметры хеша задаются настройкой (например "pbkdf2:sha256:600000" или
+# "scrypt:16384:8:1"); старые хеши пересчитываются при следующем входе.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+
+
+@functools.cache
+def hash_prefix():
+    # Префикс "метод:параметры" текущих хешей — как его запишет werkzeug.
+    # Считается при первом входе, а не при импорте: один хеш scrypt — ~0.15 с
+    return generate_password_hash("", method=PASSWORD_HASH_METHOD).split("$", 1)[0]
+# Проверка хеша — чистая нагрузка на CPU; считается прямо в потоке запроса.
+# Одновременных проверок не больше, чем потоков во всех воркерах сервера
+# (gunicorn.conf.py: workers × threads) — это и есть ограничение, отдельный
+# пул в каждом процессе его не уменьшал. HASH_WORKERS — процессы для
+# хеширования паролей при массовом импорте пользователей.
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", os.cpu_count() or 2))
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+def verify_password(pwhash, password):
+    return check_password_hash(pwhash, password)
+
+
+def needs_rehash(pwhash):
+    return pwhash.split("$", 1)[0] != hash_prefix()
+
+
+class LoginStats:
+    # Время входа по частям: поиск пользователя в БД и проверка хеша (мс)
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.ok = self.failed = self.rehashed = 0
+
+    def record(self, db_ms, hash_ms, total_ms, ok, rehashed=False):
+        with self._lock:
+            self._samples.append((db_ms, hash_ms, total_ms))
+            if ok:
+                self.ok += 1
+            else:
+                self.failed += 1
+            self.rehashed += rehashed
+
+    def stats(self):
+        with self._lock:
+            samples = list(self._samples)
+        out = {"ok": self.ok, "failed": self.failed, "rehashed": self.rehashed,
+               "samples": len(samples), "hash_method": hash_prefix()}
+        for i, part in enumerate(("db_ms", "hash_ms", "total_ms")):
+            values = sorted(s[i] for s in samples)
+            if values:
+                out[part] = {"p50": round(values[len(values) // 2], 2),
+                             "p95": round(values[min(len(values) - 1, len(values) * 95 // 100)], 2),
+                             "max": round(values[-1], 2)}
+        return out
+
+
+login_stats = LoginStats()
+
+
+# ───────── Metrics ─────────
+# Включается METRICS=1: по каждому endpoint считаем SQL-запросы, время SQL,
+# строки (загруженные ORM-объекты + изменённые DML), рендер шаблонов и общую
+# задержку. Сводка — /admin/metrics, по запросу — заголовок Server-Timing,
+# METRICS_LOG=1 пишет JSON-строку на каждый запрос. Запросы, сделавшие больше
+# METRICS_QUERY_THRESHOLD обращений к БД, логируются вместе с текстами SQL.
+METRICS_ENABLED = os.environ.get("METRICS") == "1"
+METRICS_LOG = os.environ.get("METRICS_LOG") == "1"
+METRICS_QUERY_THRESHOLD = int(os.environ.get("METRICS_QUERY_THRESHOLD", 50))
+
+
+class EndpointMetrics:
+    FIELDS = ("queries", "sql_ms", "rows", "template_ms", "total_ms")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def record(self, endpoint, sample):
+        with self._lock:
+            m = self._data.setdefault(endpoint, {"requests": 0, "slow": 0, "max_ms": 0.0,
+                                                 **{f: 0 for f in self.FIELDS}})
+            m["requests"] += 1
+            m["slow"] += sample["queries"] > METRICS_QUERY_THRESHOLD
+            m["max_ms"] = max(m["max_ms"], sample["total_ms"])
+            for f in self.FIELDS:
+                m[f] += sample[f]
+
+    def stats(self):
+        # Средние на запрос, самые медленные endpoint'ы — первыми
+        with self._lock:
+            data = {k: dict(v) for k, v in self._data.items()}
+        out = {}
+        for endpoint, m in sorted(data.items(), key=lambda kv: -kv[1]["total_ms"]):
+            n = m["requests"]
+            out[endpoint] = {"requests": n, "slow": m["slow"], "max_ms": round(m["max_ms"], 2),
+                             **{f"avg_{f}": round(m[f] / n, 2) for f in self.FIELDS}}
+        return out
+
+
+endpoint_metrics = EndpointMetrics()
+
+
+def current_metrics():
+    return g.get("metrics") if has_request_context() else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_metrics() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    m = current_metrics()
+    if m is None or not conn.info.get("query_started"):
+        return
+    elapsed = (time.perf_counter() - conn.info["query_started"].pop()) * 1000
+    m["queries"] += 1
+    m["sql_ms"] += elapsed
+    if not statement.lstrip().upper().startswith("SELECT") and cursor.rowcount > 0:
+        m["rows"] += cursor.rowcount
+    m["statements"].append((statement, elapsed))
+
+
+def _loaded_as_persistent(session_, instance):
+    m = current_metrics()
+    if m is not None:
+        m["rows"] += 1
+
+
+def _before_render(sender, template, context, **extra):
+    m = current_metrics()
+    if m is not None:
+        m["template_started"] = time.perf_counter()
+
+
+def _template_rendered(sender, template, context, **extra):
+    m = current_metrics()
+    if m is not None and m.get("template_started"):
+        m["template_ms"] += (time.perf_counter() - m.pop("template_started")) * 1000
+
+
+if METRICS_ENABLED:
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(db.engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(db.session, "loaded_as_persistent", _loaded_as_persistent)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_template_rendered, app)
+    if METRICS_LOG:
+        app.logger.setLevel(logging.INFO)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics = {"started": time.perf_counter(), "queries": 0, "sql_ms": 0.0,
+                     "rows": 0, "template_ms": 0.0, "statements": []}
+
+    @app.after_request
+    def finish_request_metrics(response):
+        m = g.get("metrics")
+        if m is None:
+            return response
+        info = (request.endpoint or "<404>", request.method, request.path)
+        if response.is_streamed:
+            # Тело (CSV-выгрузки) строится уже после after_request: SQL генератора
+            # копится в том же m, итог записываем, когда сервер закроет ответ
+            response.call_on_close(lambda: record_request_metrics(m, *info, response.status_code))
+            return response
+        g.pop("metrics")
+        sample = record_request_metrics(m, *info, response.status_code)
+        response.headers["Server-Timing"] = (
+            f'sql;dur={sample["sql_ms"]:.1f};desc="{sample["queries"]} queries", '
+            f'tpl;dur={sample["template_ms"]:.1f}, total;dur={sample["total_ms"]:.1f}')
+        return response
+
+
+def record_request_metrics(m, endpoint, method, path, status):
+    sample = {"queries": m["queries"], "sql_ms": m["sql_ms"], "rows": m["rows"],
+              "template_ms": m["template_ms"],
+              "total_ms": (time.perf_counter() - m["started"]) * 1000}
+    endpoint_metrics.record(endpoint, sample)
+    if METRICS_LOG:
+        app.logger.info(json.dumps({"endpoint": endpoint, "method": method, "status": status,
+                                    **{k: round(v, 2) for k, v in sample.items()}}))
+    if sample["queries"] > METRICS_QUERY_THRESHOLD:
+        # Одинаковые тексты SQL склеиваем — N+1 видно по счётчику
+        grouped = OrderedDict()
+        for statement, elapsed in m["statements"]:
+            n, total = grouped.get(statement, (0, 0.0))
+            grouped[statement] = (n + 1, total + elapsed)
+        app.logger.warning("%s %s: %d queries (threshold %d), %.1f ms SQL\n%s",
+                           method, path, sample["queries"],
+                           METRICS_QUERY_THRESHOLD, sample["sql_ms"],
+                           "\n".join(f"  {n}x {total:.1f} ms  {' '.join(statement.split())}"
+                                      for statement, (n, total) in grouped.items()))
+    return sample
+
+
+# ───────── Session user ─────────
+# В cookie — только user_id. Роль и имя читаются из кэша записей пользователей
+# не чаще раза за запрос. Запись кэша хранит версию "users" (DataVersion), и
+# каждый запрос сверяет её с БД одним чтением по ключу: смена роли или удаление
+# (edit_user/delete_user поднимают версию) действуют сразу во всех воркерах.
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 60))  # секунды
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+SessionUser = namedtuple("SessionUser", "id username role fullname")
+
+ACCESS_MESSAGES = {
+    (): "Требуется вход",
+    ("student",): "Доступ только для студентов",
+    ("teacher",): "Доступ только для учителей",
+    ("admin",): "Доступ только для админов",
+    ("teacher", "admin"): "Доступ только для учителей/админов",
+}
+
+
+class UserCache:
+    # id → (SessionUser или None для удалённых, момент загрузки, версия "users"); LRU + TTL
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, user_id):
+        version = users_version()
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is not None and entry[2] == version and time.monotonic() - entry[1] < self.ttl:
+                self._data.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        row = db.session.query(User.id, User.username, User.role, User.fullname) \
+            .filter(User.id == user_id).first()
+        user = SessionUser(*row) if row else None
+        self.set(user_id, user, version)
+        return user
+
+    def set(self, user_id, user, version=None):
+        # version — прочитанная до загрузки user; без неё читаем текущую
+        if version is None:
+            version = users_version()
+        with self._lock:
+            self._data[user_id] = (user, time.monotonic(), version)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "max_size": self.max_size, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses}
+
+
+user_cache = UserCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+
+
+def users_version():
+    return data_versions(["users"])[0]
+
+
+def current_user():
+    # Пользователь текущего запроса (SessionUser или None)
+    if "current_user" not in g:
+        user_id = session.get("user_id")
+        g.current_user = user_cache.get(user_id) if user_id is not None else None
+        if g.current_user is None and user_id is not None:
+            session.clear()  # пользователь удалён
+    return g.current_user
+
+
+def role_required(*roles, api=False):
+    # Пускает вошедших пользователей с одной из ролей (без ролей — любых).
+    # Страницы отправляют на вход с сообщением, api=True (или функция,
+    # возвращающая True для JSON-запроса) — отвечает 401/403.
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            user = current_user()
+            if user is not None and (not roles or user.role in roles):
+                return view(*args, **kwargs)
+            if api() if callable(api) else api:
+                return ({"error": "unauthorized"}, 401) if user is None else ({"error": "forbidden"}, 403)
+            flash(ACCESS_MESSAGES.get(roles if user else (), ACCESS_MESSAGES[()]), "danger")
+            return redirect(url_for("login"))
+        return wrapper
+    return decorator
+
+
+def wants_json():
+    return request.args.get("format") == "json"
+
+
+@app.context_processor
+def inject_current_user():
+    return dict(current_user=current_user())
+
+
 # ───────── Auth ─────────
 @app.route("/")
 def index():
-    if "user_id" in session:
+    if current_user():
         return redirect(url_for("dashboard"))
     return redirect(url_for("login"))
 
@@ -134,12 +1727,23 @@ def login():
     if request.method == "POST":
         username = request.form["username"].strip()
         password = request.form["password"].strip()
+        started = time.perf_counter()
+        # Поиск по уникальному индексу username
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password_hash, password):
+        looked_up = time.perf_counter()
+        ok = bool(user) and verify_password(user.password_hash, password)
+        checked = time.perf_counter()
+        rehashed = ok and needs_rehash(user.password_hash)
+        if rehashed:
+            user.password_hash = hash_password(password)
+            db.session.commit()
+        db_ms, hash_ms = (looked_up - started) * 1000, (checked - looked_up) * 1000
+        login_stats.record(db_ms, hash_ms, (time.perf_counter() - started) * 1000, ok, rehashed)
+        app.logger.debug("login %s: db %.1f ms, hash %.1f ms", username, db_ms, hash_ms)
+        if ok:
+            session.clear()
             session["user_id"] = user.id
-            session["role"] = user.role
-            session["username"] = user.username
-            session["fullname"] = user.fullname
+            user_cache.set(user.id, SessionUser(user.id, user.username, user.role, user.fullname))
             flash("Вход выполнен", "success")
             return redirect(url_for("dashboard"))
         error = "Неправильный логин или пароль"
@@ -153,15 +1757,9 @@ def logout():
     return redirect(url_for("login"))
 
 # ───────── Dashboard ─────────
-@app.route("/dashboard")
-def dashboard():
-    if "user_id" not in session:
-        flash("Требуется вход", "danger")
-        return redirect(url_for("login"))
-
-    role = session.get("role")
-
-    news = [
+# Карточки новостей рендерятся один раз (фрагмент "news"); после правки
+# списка в работающем процессе — invalidate_fragments("news")
+NEWS = [
     {"title": "Запущена олимпиада", "desc": "Математика и русский язык.",
      "url": "https://www.gov.kz/memleket/entities/edu?lang=ru",
      "image": "https://picsum.photos/400/200?random=1",
@@ -177,66 +1775,58 @@ def dashboard():
 ]
 
 
-
-    return render_template("dashboard.html", role=role, news=news)
+@app.route("/dashboard")
+@role_required()
+def dashboard():
+    return render_template("dashboard.html", role=current_user().role, news=NEWS)
 
 
 # ───────── Student ─────────
 @app.route("/student")
+@role_required("student")
 def student_page():
-    if "user_id" not in session or session.get("role") != "student":
-        flash("Доступ только для студентов", "danger")
-        return redirect(url_for("login"))
-
-    student_id = session["user_id"]
+    student_id = current_user().id
     year = int(request.args.get("year", current_year()))
 
     subjects = Subject.query.all()
     subject_map = {s.id: s.name for s in subjects}
 
-    grades = Grade.query.filter_by(student_id=student_id, year=year).all()
+    src = grade_table(year)
+    grades = src.query.filter_by(student_id=student_id, year=year).order_by(src.id).all()
 
-    avg = {}
-    for g in grades:
-        subjname = subject_map.get(g.subject_id, "")
-        avg.setdefault(subjname, []).append(g.value)
-    avg = {k: round(sum(v)/len(v), 2) if v else 0 for k, v in avg.items()}
+    aggs = grade_aggregates(year, student_id=student_id).get(student_id, {})
+    avg = {subject_map.get(subj_id, ""): avg_of(count, total)
+           for subj_id, (count, total) in aggs.items()}
 
     return render_template("student.html", grades=grades, avg=avg, year=year, subject_map=subject_map)
 
+def student_report_data(student_id, year, subjects):
+    subject_map = {s.id: s.name for s in subjects}
+    aggs = grade_aggregates(year, student_id=student_id).get(student_id, {})
+    subj_avgs = {subject_map.get(subj_id, ""): avg_of(count, total)
+                 for subj_id, (count, total) in aggs.items()}
+    return subj_avgs, avg_of(*student_totals(aggs))
+
+
 @app.route("/student/report")
+@role_required("student")
 def student_report():
-    if "user_id" not in session or session.get("role") != "student":
-        flash("Доступ только для студентов", "danger")
-        return redirect(url_for("login"))
-
-    student_id = session["user_id"]
+    student_id = current_user().id
     year = int(request.args.get("year", current_year()))
 
     subjects = Subject.query.all()
-    subject_map = {s.id: s.name for s in subjects}
-
-    grades = Grade.query.filter_by(student_id=student_id, year=year).all()
-
-    subj_avgs = {}
-    for g in grades:
-        subjname = subject_map.get(g.subject_id, "")
-        subj_avgs.setdefault(subjname, []).append(g.value)
-    subj_avgs = {k: round(sum(v)/len(v), 2) if v else 0 for k, v in subj_avgs.items()}
-    overall = round(sum([g.value for g in grades])/len(grades), 2) if grades else 0
+    subj_avgs, overall = cached_report(ReportKey("student_report", year, "year", 0, student_id),
+                                       lambda: student_report_data(student_id, year, subjects))
 
     return render_template("student_report.html", year=year,
                            subject_avgs=subj_avgs, overall_avg=overall, subjects=subjects)
 
 # ───────── Teacher ─────────
 @app.route("/teacher", methods=["GET", "POST"])
+@role_required("teacher")
 def teacher_page():
-    if "user_id" not in session or session.get("role") != "teacher":
-        flash("Доступ только для учителей", "danger")
-        return redirect(url_for("login"))
-
-    subjects = Subject.query.all()
-    students = User.query.filter_by(role="student").all()
+    teacher_id = current_user().id
+    classes = teacher_classes(teacher_id)
     message = ""
 
     if request.method == "POST":
@@ -245,36 +1835,44 @@ def teacher_page():
         quarter = int(request.form["quarter"])
         week = int(request.form.get("week", 1))
 
-        for st in students:
-            key = f"student_{st.id}"
-            raw = request.form.get(key, "").strip()
-            if not raw:
-                continue
-            try:
-                value = int(raw)
-            except ValueError:
-                continue
-            if value < 2 or value > 5:
-                continue
-
-            existing = Grade.query.filter_by(
-                student_id=st.id, subject_id=subject_id,
-                year=year, quarter=quarter, week=week
-            ).first()
-            if existing:
-                existing.value = value
-            else:
-                db.session.add(Grade(
-                    student_id=st.id, subject_id=subject_id, value=value,
-                    year=year, quarter=quarter, week=week
-                ))
-        db.session.commit()
-        message = "Оценки сохранены."
+        values, skipped = parse_grade_form(request.form)
+        # Оценки ставим только ученикам из классов, где учитель ведёт этот предмет —
+        # одним запросом по всем id из формы
+        allowed = scoped_students(teacher_id, subject_id=subject_id)
+        student_ids = set()
+        for ids in chunked(list(values)):
+            student_ids.update(uid for (uid,) in allowed.filter(User.id.in_(ids))
+                               .with_entities(User.id))
+        skipped += len(values) - len(student_ids)
+
+        with grade_writer():
+            stats = upsert_grades([
+                dict(student_id=sid, subject_id=subject_id, year=year,
+                     quarter=quarter, week=week, value=values[sid])
+                for sid in student_ids
+            ])
+            db.session.commit()
+        if stats["inserted"] or stats["updated"]:
+            invalidate_grade_reports(year, quarter, subject_id, student_ids)
+        stats["skipped"] += skipped
+        message = ("Оценки сохранены: добавлено {inserted}, обновлено {updated}, "
+                   "пропущено {skipped}.".format(**stats))
+        if (year, quarter) in locked_quarters():
+            message += f" {quarter} четверть {year} года закрыта — её оценки не меняются."
+
+    # Журнал показываем постранично: форма сохраняет только учеников текущей страницы
+    order = request.args.get("order", "id")
+    class_id = int(request.args.get("class_id", 0))
+    query = filter_users(scoped_students(teacher_id, class_id), request.args.get("q", "").strip())
+    students, next_cursor = keyset_page(query, order, request.args.get("after"))
 
     # ⚡ исправлено: передаём функцию, а не число
+    # Предметы запрашиваются, только если их список не в кэше фрагментов
     return render_template("teacher.html",
-                           subjects=subjects, students=students,
-                           message=message, current_year=current_year)
+                           load_subjects=functools.partial(teacher_subjects, teacher_id), students=students, classes=classes,
+                           class_id=class_id, message=message, current_year=current_year,
+                           next_cursor=next_cursor, order=order,
+                           page_args=page_args("q", "order", "class_id", "subject", "year", "quarter", "week"))
 
 
 # ⚡ новый алиас для старых ссылок
@@ -285,165 +1883,925 @@ def export_class():
 
 
 
+def teacher_report_data(year, period, subject_id, teacher_id=None, class_id=0):
+    quarters = period_quarters(period)
+    students = teacher_student_ids(teacher_id, class_id, subject_id)
+    aggs = grade_aggregates(year, subject_id=subject_id, quarters=quarters, students=students)
+    values = grade_values(year, subject_id=subject_id, quarters=quarters, students=students)
+
+    report_data = []
+    for st in scoped_students(teacher_id, class_id, subject_id).order_by(User.id).all():
+        count, total = student_totals(aggs.get(st.id, {}))
+        report_data.append((st.fullname or st.username, values.get(st.id, []), avg_of(count, total)))
+    return report_data
+
+
 @app.route("/teacher/report")
+@role_required("teacher")
 def teacher_report():
-    if "user_id" not in session or session.get("role") != "teacher":
-        flash("Доступ только для учителей", "danger")
-        return redirect(url_for("login"))
-
     subject_id = int(request.args.get("subject", 0))
     year = int(request.args.get("year", current_year()))
     period = request.args.get("period", "year")  # quarter1..4, halfyear1/2, year
+    class_id = int(request.args.get("class_id", 0))
 
-    subjects = Subject.query.all()
-    students = User.query.filter_by(role="student").all()
+    teacher_id = current_user().id
+    report_key = ReportKey("teacher_report", year, period, subject_id, (teacher_id, class_id))
+    report_data = cached_report(
+        report_key, lambda: teacher_report_data(year, period, subject_id, teacher_id, class_id))
 
-    if period.startswith("quarter"):
-        quarters = [int(period[-1])]
-    elif period == "halfyear1":
-        quarters = [1, 2]
-    elif period == "halfyear2":
-        quarters = [3, 4]
-    else:
-        quarters = [1, 2, 3, 4]
+    return render_template("teacher_report.html",
+                           load_subjects=functools.partial(teacher_subjects, teacher_id), subject_id=subject_id,
+                           classes=teacher_classes(teacher_id), class_id=class_id,
+                           year=year, period=period, report_data=report_data, report_key=report_key)
+
+# ───────── Teacher: журнал по неделям ─────────
+# Сетка ученик × неделя для предмета, года и четверти. Состав учеников и
+# оценки — один запрос (LEFT JOIN), разворот в матрицу — один проход по строкам.
+GRADEBOOK_WEEKS = int(os.environ.get("GRADEBOOK_WEEKS", 10))
+
+
+def gradebook_roster(teacher_id, subject_ids, class_id=0):
+    # Пары (subject_id, student_id), которые учитель может видеть и оценивать
+    if not classes_configured():
+        return db.select(Subject.id.label("subject_id"), User.id.label("student_id")) \
+            .where(User.role == "student", Subject.id.in_(subject_ids))
+    q = db.select(TeachingAssignment.subject_id, ClassStudent.student_id).join(
+        ClassStudent, ClassStudent.class_id == TeachingAssignment.class_id
+    ).where(TeachingAssignment.teacher_id == teacher_id,
+            TeachingAssignment.subject_id.in_(subject_ids))
+    if class_id:
+        q = q.where(TeachingAssignment.class_id == class_id)
+    return q.distinct()
+
+
+def gradebook_data(teacher_id, year, quarter, subject_ids, class_id=0):
+    # {subject_id: {"students": [(id, имя)], "cells": [[оценка или None по неделям]],
+    #               "averages": [средний по строке]}}, число недель
+    src = grade_table(year)
+    roster = gradebook_roster(teacher_id, subject_ids, class_id).subquery()
+    q = db.select(roster.c.subject_id, User.id, USER_DISPLAY_NAME, src.week, src.value) \
+        .join(User, User.id == roster.c.student_id) \
+        .outerjoin(src, and_(src.student_id == roster.c.student_id,
+                             src.subject_id == roster.c.subject_id,
+                             src.year == year, src.quarter == quarter,
+                             src.week.isnot(None))) \
+        .order_by(roster.c.subject_id, USER_DISPLAY_NAME, User.id)
+
+    grids = {subject_id: {"students": [], "cells": []} for subject_id in subject_ids}
+    weeks, last = GRADEBOOK_WEEKS, None
+    for subject_id, student_id, name, week, value in db.session.execute(q):
+        grid = grids[subject_id]
+        if (subject_id, student_id) != last:
+            last = (subject_id, student_id)
+            grid["students"].append((student_id, name))
+            grid["cells"].append([None] * weeks)
+        if week is None:
+            continue
+        row = grid["cells"][-1]
+        if week > len(row):
+            row.extend([None] * (week - len(row)))
+        row[week - 1] = value
+    # Недели сверх GRADEBOOK_WEEKS (если такие есть в данных) — общая ширина сетки
+    weeks = max([weeks] + [len(row) for grid in grids.values() for row in grid["cells"]])
+    for grid in grids.values():
+        grid["averages"] = []
+        for row in grid["cells"]:
+            row.extend([None] * (weeks - len(row)))
+            marks = [v for v in row if v is not None]
+            grid["averages"].append(avg_of(len(marks), sum(marks), None))
+    return grids, weeks
+
+
+def parse_gradebook_form(form):
+    # Поля g_<предмет>_<ученик>_<неделя> → {(subject_id, student_id, week): value}
+    cells, skipped = {}, 0
+    for key, raw in form.items():
+        if not key.startswith("g_") or not raw.strip():
+            continue
+        try:
+            subject_id, student_id, week = map(int, key[2:].split("_"))
+            value = int(raw)
+        except ValueError:
+            skipped += 1
+            continue
+        if not 2 <= value <= 5 or not 1 <= week <= 53:
+            skipped += 1
+            continue
+        cells[(subject_id, student_id, week)] = value
+    return cells, skipped
+
+
+def save_gradebook(teacher_id, year, quarter, cells):
+    # Изменённые ячейки — одной пачкой через upsert_grades; ячейки вне
+    # классов учителя отбрасываются одной проверкой по составу
+    roster = gradebook_roster(teacher_id, sorted({subject_id for subject_id, _, _ in cells})).subquery()
+    allowed = set()
+    for ids in chunked(sorted({student_id for _, student_id, _ in cells})):
+        allowed.update(map(tuple, db.session.execute(
+            db.select(roster).where(roster.c.student_id.in_(ids)))))
+    rows = [dict(student_id=student_id, subject_id=subject_id, year=year,
+                 quarter=quarter, week=week, value=value)
+            for (subject_id, student_id, week), value in cells.items()
+            if (subject_id, student_id) in allowed]
+    with grade_writer():
+        stats = upsert_grades(rows)
+        db.session.commit()
+    stats["skipped"] += len(cells) - len(rows)
+    if stats["inserted"] or stats["updated"]:
+        touched = {}
+        for row in rows:
+            touched.setdefault(row["subject_id"], set()).add(row["student_id"])
+        for subject_id, ids in touched.items():
+            invalidate_grade_reports(year, quarter, subject_id, ids)
+    return stats
+
+
+@app.route("/teacher/gradebook", methods=["GET", "POST"])
+@role_required("teacher", api=wants_json)
+def teacher_gradebook():
+    teacher_id = current_user().id
+    year = int(request.values.get("year", current_year()))
+    quarter = min(max(int(request.values.get("quarter", 1)), 1), 4)
+    class_id = int(request.values.get("class_id", 0))
+    subject_id = int(request.values.get("subject", 0))  # 0 — все предметы учителя
 
-    report_data = []
-    for st in students:
-        q = Grade.query.filter_by(student_id=st.id, year=year)
-        if subject_id != 0:
-            q = q.filter_by(subject_id=subject_id)
-        q = q.filter(Grade.quarter.in_(quarters))
-        grades = [g.value for g in q.all()]
-        avg = round(sum(grades)/len(grades), 2) if grades else 0
-        report_data.append((st.fullname or st.username, grades, avg))
+    if request.method == "POST":
+        cells, skipped = parse_gradebook_form(request.form)
+        stats = save_gradebook(teacher_id, year, quarter, cells)
+        stats["skipped"] += skipped
+        flash("Журнал сохранён: добавлено {inserted}, обновлено {updated}, "
+              "пропущено {skipped}.".format(**stats), "success")
+        return redirect(url_for("teacher_gradebook", year=year, quarter=quarter,
+                                class_id=class_id or None, subject=subject_id or None))
+
+    subjects = teacher_subjects(teacher_id)
+    shown = [s for s in subjects if s.id == subject_id] if subject_id else subjects
+    grids, weeks = gradebook_data(teacher_id, year, quarter, [s.id for s in shown], class_id)
+    if wants_json():
+        return {"year": year, "quarter": quarter, "weeks": weeks,
+                "subjects": [dict(id=s.id, name=s.name, **grids[s.id]) for s in shown]}
+    return render_template("teacher_gradebook.html",
+                           subjects=subjects, shown=shown, grids=grids, weeks=weeks,
+                           classes=teacher_classes(teacher_id), class_id=class_id,
+                           subject_id=subject_id, year=year, quarter=quarter,
+                           locked=(year, quarter) in locked_quarters())
 
-    return render_template("teacher_report.html",
-                           subjects=subjects, subject_id=subject_id,
-                           year=year, period=period, report_data=report_data)
 
 # ───────── Excel exports ─────────
-def autosize_columns(ws):
-    for col in ws.columns:
-        max_len = 0
-        col_letter = get_column_letter(col[0].column)
-        for cell in col:
-            try:
-                max_len = max(max_len, len(str(cell.value)) if cell.value else 0)
-            except Exception:
-                pass
-        ws.column_dimensions[col_letter].width = max(12, min(40, max_len + 2))
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def column_widths(rows):
+    # Ширина колонок считается заранее: write-only лист нельзя перечитать
+    # после записи. Правило то же, что было в autosize: 12..40 символов.
+    widths = {}
+    for row in rows:
+        for idx, value in enumerate(row, start=1):
+            widths[idx] = max(widths.get(idx, 0), len(str(value)) if value else 0)
+    return {idx: max(12, min(40, n + 2)) for idx, n in widths.items()}
+
+
+def write_xlsx(title, rows, chart=None):
+    # rows — функция, возвращающая новый итератор строк (заголовок первым):
+    # первый проход считает ширины, второй пишет строки в write-only лист,
+    # так что в памяти не держится ни одна ячейка. Результат — BytesIO,
+    # без общего файла в instance/.
+    from openpyxl import Workbook
+    from openpyxl.chart import BarChart, Reference
+    from openpyxl.utils import get_column_letter
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    for idx, width in column_widths(rows()).items():
+        ws.column_dimensions[get_column_letter(idx)].width = width
+
+    data_end = 0
+    for row in rows():
+        ws.append(row)
+        data_end += 1
+
+    if chart and data_end >= 2:
+        bar = BarChart()
+        bar.title = chart["title"]
+        values = Reference(ws, min_col=chart["col"], min_row=1, max_row=data_end)
+        cats = Reference(ws, min_col=1, min_row=2, max_row=data_end)
+        bar.add_data(values, titles_from_data=True)
+        bar.set_categories(cats)
+        bar.y_axis.title = "Средний балл"
+        bar.x_axis.title = chart["x_title"]
+        ws.add_chart(bar, chart["anchor"])
+
+    buf = io.BytesIO()
+    wb.save(buf)
+    buf.seek(0)
+    return buf
+
+
+def xlsx_response(buf, filename):
+    return send_file(buf, as_attachment=True, download_name=filename, mimetype=XLSX_MIMETYPE)
+
+
+def student_rows(teacher_id=None, class_id=0, subject_id=0):
+    # Лёгкие кортежи вместо ORM-объектов — экспорт может быть на всю школу
+    return scoped_students(teacher_id, class_id, subject_id) \
+        .with_entities(User.id, User.fullname, User.username).order_by(User.id).all()
+
+
+def build_teacher_xlsx(subject_id, year, quarter, week, teacher_id=None, class_id=0):
+    subject = db.session.get(Subject, subject_id) if subject_id != 0 else None
+    students = student_rows(teacher_id, class_id, subject_id)
+    scope = teacher_student_ids(teacher_id, class_id, subject_id)
+
+    quarters = [quarter] if quarter else None
+    aggs = grade_aggregates(year, subject_id=subject_id, quarters=quarters, week=week, students=scope)
+    values = grade_values(year, subject_id=subject_id, quarters=quarters, week=week, students=scope)
+
+    subjname = subject.name if subject else "Все"
+    period_str = f"{year}, Q{quarter if quarter else '1-4'}"
+    week_str = week if week else "все"
+
+    def rows():
+        yield ["ФИО ученика", "Предмет", "Период", "Неделя", "Оценки", "Средний балл"]
+        for st_id, fullname, username in students:
+            count, total = student_totals(aggs.get(st_id, {}))
+            yield [fullname or username, subjname, period_str, week_str,
+                   ";".join(map(str, values.get(st_id, []))), avg_of(count, total, empty="")]
+
+    # Диаграмма по средним (колонка F)
+    return write_xlsx("Отчет класса", rows, chart={
+        "title": "Средний балл по ученикам", "x_title": "Ученик", "col": 6, "anchor": "H2",
+    })
+
+
+def build_student_xlsx(student_id, year):
+    subjects = Subject.query.all()
+    aggs = grade_aggregates(year, student_id=student_id).get(student_id, {})
+
+    def rows():
+        yield ["Предмет", "Средний балл"]
+        for s in subjects:
+            yield [s.name, avg_of(*aggs.get(s.id, (0, 0)))]
+
+    # Диаграмма по предметам
+    return write_xlsx(f"Отчёт {year}", rows, chart={
+        "title": "Средний балл по предметам", "x_title": "Предмет", "col": 2, "anchor": "E2",
+    })
+
+
+def build_admin_xlsx(year):
+    students = student_rows()
+    subjects = Subject.query.all()
+    m = grade_matrices.get(year)
+    counts, totals = m.sums()
+    counts, totals = counts.tolist(), totals.tolist()
+    columns = [m.subject_index.get(s.id) for s in subjects]
+    last_col = len(subjects) + 2
+
+    def rows():
+        yield ["Ученик"] + [s.name for s in subjects] + ["Общий средний"]
+        for st_id, fullname, username in students:
+            i = m.index.get(st_id)
+            row = [fullname or username]
+            vals_for_mean = []
+            for j in columns:
+                if i is None or j is None:
+                    avg = ""
+                else:
+                    avg = avg_of(counts[i][j], totals[i][j], empty="")
+                row.append(avg)
+                if isinstance(avg, (int, float)):
+                    vals_for_mean.append(avg)
+            overall = round(sum(vals_for_mean)/len(vals_for_mean), 2) if vals_for_mean else ""
+            row.append(overall)
+            yield row
+
+    # Диаграмма по общему среднему
+    from openpyxl.utils import get_column_letter
+    return write_xlsx(f"Итоги {year}", rows, chart={
+        "title": "Общий средний балл (по ученикам)", "x_title": "Ученик",
+        "col": last_col, "anchor": f"{get_column_letter(last_col+2)}2",
+    })
+
+
+# ───────── Background exports ─────────
+# Большие выгрузки строятся в пуле процессов; клиент опрашивает статус и
+# скачивает готовый файл. Состояние задачи лежит в instance/exports/<id>.json,
+# поэтому статус и скачивание обслуживает любой воркер. Одинаковые запросы
+# склеиваются через файл-замок <sha1 ключа>.lock с job_id строящейся задачи —
+# тоже общий для всех воркеров.
+EXPORT_DIR = os.path.join(INSTANCE_DIR, "exports")
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", 2))
+EXPORT_MAX_AGE = int(os.environ.get("EXPORT_MAX_AGE", 3600))  # секунды
+EXPORT_MAX_BYTES = int(os.environ.get("EXPORT_MAX_BYTES", 200 * 1024 * 1024))
+
+EXPORT_BUILDERS = {
+    "teacher": lambda p: build_teacher_xlsx(p["subject"], p["year"], p["quarter"], p["week"],
+                                            p["teacher"], p["class_id"]),
+    "admin": lambda p: build_admin_xlsx(p["year"]),
+}
+
+_export_pool = None
+_export_lock = threading.Lock()
+
+
+def export_path(job_id, ext):
+    return os.path.join(EXPORT_DIR, f"{job_id}.{ext}")
+
+
+def read_export_meta(job_id):
+    try:
+        with open(export_path(job_id, "json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_export_meta(job_id, meta):
+    path = export_path(job_id, "json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def _export_worker_init():
+    # Соединения с БД, унаследованные от родителя, в дочернем процессе не используем
+    with app.app_context():
+        db.engine.dispose(close=False)
+    # Выгрузки редкие — матрицу каждый раз строим заново, не держа в памяти.
+    # Матрицы, унаследованные при fork, — снимок на момент fork: сбрасываем
+    grade_matrices.clear()
+    grade_matrices.max_years = 0
+
+
+def run_export_job(job_id, kind, params):
+    # Выполняется в процессе пула
+    meta = read_export_meta(job_id) or {}
+    meta["status"] = "running"
+    write_export_meta(job_id, meta)
+    try:
+        with app.app_context():
+            buf = EXPORT_BUILDERS[kind](params)
+        path = export_path(job_id, "xlsx")
+        with open(path + ".tmp", "wb") as f:
+            f.write(buf.getbuffer())
+        os.replace(path + ".tmp", path)
+        meta.update(status="done", size=os.path.getsize(path), finished=time.time())
+    except Exception as e:
+        meta.update(status="failed", error=str(e))
+    write_export_meta(job_id, meta)
+
+
+def export_pool():
+    global _export_pool
+    with _export_lock:
+        if _export_pool is None:
+            _export_pool = ProcessPoolExecutor(max_workers=EXPORT_WORKERS,
+                                               initializer=_export_worker_init)
+        return _export_pool
+
+
+def reset_export_pool(pool):
+    # Процесс пула упал — пул сломан (BrokenProcessPool), следующая задача создаст новый
+    global _export_pool
+    with _export_lock:
+        if _export_pool is pool:
+            _export_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def evict_exports():
+    # Удаляем задачи старше EXPORT_MAX_AGE (и зависшие в pending/running),
+    # затем самые старые готовые, пока суммарный размер не уложится в EXPORT_MAX_BYTES
+    if not os.path.isdir(EXPORT_DIR):
+        return
+    now = time.time()
+    done = []
+    for name in os.listdir(EXPORT_DIR):
+        if name.endswith(".lock"):
+            # Замок задачи, которую уже удалили: inflight_export снимет его и сам,
+            # здесь — чтобы не копились замки неповторяющихся запросов
+            if read_export_meta(read_export_lock(os.path.join(EXPORT_DIR, name))) is None:
+                release_export_lock(os.path.join(EXPORT_DIR, name))
+            continue
+        if not name.endswith(".json"):
+            continue
+        job_id = name[:-len(".json")]
+        meta = read_export_meta(job_id)
+        if meta is None:
+            continue
+        if now - meta.get("created", 0) > EXPORT_MAX_AGE:
+            remove_export(job_id)
+        elif meta["status"] == "done":
+            done.append((meta.get("finished", 0), job_id, meta.get("size", 0)))
+    total = sum(size for _, _, size in done)
+    for _, job_id, size in sorted(done):
+        if total <= EXPORT_MAX_BYTES:
+            break
+        remove_export(job_id)
+        total -= size
+
+
+def remove_export(job_id):
+    for ext in ("xlsx", "json"):
+        try:
+            os.remove(export_path(job_id, ext))
+        except OSError:
+            pass
+
+
+def read_export_lock(lock):
+    try:
+        with open(lock, encoding="ascii") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def claim_export_lock(lock, job_id):
+    # Замок появляется сразу с job_id внутри: link, в отличие от rename,
+    # не перезаписывает существующий файл. False — замок уже чей-то
+    tmp = f"{lock}.{job_id}"
+    with open(tmp, "w", encoding="ascii") as f:
+        f.write(job_id)
+    try:
+        os.link(tmp, lock)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp)
+
+
+def release_export_lock(lock, job_id=None):
+    # Снимаем замок, только если он всё ещё указывает на эту задачу. Между
+    # проверкой и удалением замок может смениться — худший случай: одна
+    # повторная сборка того же файла
+    if job_id is None or read_export_lock(lock) == job_id:
+        try:
+            os.remove(lock)
+        except OSError:
+            pass
+
+
+def inflight_export(lock):
+    # job_id задачи, которая по замку ещё строится; устаревший замок снимаем
+    job_id = read_export_lock(lock)
+    if not job_id:
+        return None
+    meta = read_export_meta(job_id)
+    if (meta is not None and meta["status"] in ("pending", "running")
+            and time.time() - meta.get("created", 0) <= EXPORT_MAX_AGE):
+        return job_id
+    release_export_lock(lock, job_id)
+    return None
+
+
+def fail_export(job_id, error):
+    meta = read_export_meta(job_id) or {}
+    if meta.get("status") in ("pending", "running"):
+        meta.update(status="failed", error=error)
+        write_export_meta(job_id, meta)
+
+
+def export_finished(job_id, lock, pool, future):
+    # Вызывается в процессе, отправившем задачу; итог задача пишет сама,
+    # кроме случая, когда процесс пула умер посреди работы
+    release_export_lock(lock, job_id)
+    if not future.cancelled() and future.exception() is not None:
+        reset_export_pool(pool)
+        fail_export(job_id, "процесс выгрузки завершился аварийно")
+
+
+def submit_export(job_id, kind, params, lock):
+    # Сломанный пул пересоздаём и пробуем ещё раз
+    for _ in range(2):
+        pool = export_pool()
+        try:
+            future = pool.submit(run_export_job, job_id, kind, params)
+        except (BrokenProcessPool, RuntimeError):
+            reset_export_pool(pool)
+            continue
+        future.add_done_callback(functools.partial(export_finished, job_id, lock, pool))
+        return
+    release_export_lock(lock, job_id)
+    fail_export(job_id, "пул выгрузок недоступен")
+
+
+def start_export(kind, params, filename):
+    # Одинаковые запросы (роль, год, предмет, четверть, неделя), пока задача
+    # ещё строится, получают один и тот же job_id — в любом воркере
+    key = json.dumps([kind, current_user().role, params], sort_keys=True)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    lock = os.path.join(EXPORT_DIR, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".lock")
+    job_id = uuid.uuid4().hex
+    # Метаданные — до замка: кто увидит замок, найдёт и задачу
+    write_export_meta(job_id, {
+        "status": "pending", "kind": kind, "filename": filename,
+        "owner": current_user().id, "created": time.time(),
+    })
+    for _ in range(3):
+        existing = inflight_export(lock)
+        if existing:
+            remove_export(job_id)
+            return redirect(url_for("export_job", job_id=existing))
+        if claim_export_lock(lock, job_id):
+            break
+    evict_exports()
+    submit_export(job_id, kind, params, lock)
+    return redirect(url_for("export_job", job_id=job_id))
+
+
+def load_export_job(job_id):
+    # Задачу видит только тот, кто её запустил (или админ)
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        return None
+    meta = read_export_meta(job_id)
+    if meta is None:
+        return None
+    user = current_user()
+    if meta.get("owner") != user.id and user.role != "admin":
+        return None
+    return meta
+
+
+@app.route("/export/jobs/<job_id>")
+@role_required()
+def export_job(job_id):
+    meta = load_export_job(job_id)
+    if meta is None:
+        flash("Выгрузка не найдена или устарела", "danger")
+        return redirect(url_for("dashboard"))
+    return render_template("export_job.html", job_id=job_id, meta=meta)
+
+
+@app.route("/export/jobs/<job_id>/status")
+@role_required(api=True)
+def export_job_status(job_id):
+    meta = load_export_job(job_id)
+    if meta is None:
+        return {"error": "not found"}, 404
+    result = {"id": job_id, "status": meta["status"]}
+    if meta["status"] == "done":
+        result["download_url"] = url_for("export_job_download", job_id=job_id)
+    if meta["status"] == "failed":
+        result["error"] = meta.get("error", "")
+    return result
+
+
+@app.route("/export/jobs/<job_id>/download")
+@role_required()
+def export_job_download(job_id):
+    meta = load_export_job(job_id)
+    if meta is None or meta["status"] != "done":
+        flash("Выгрузка ещё не готова", "info")
+        return redirect(url_for("export_job", job_id=job_id) if meta else url_for("dashboard"))
+    return send_file(export_path(job_id, "xlsx"), as_attachment=True,
+                     download_name=meta["filename"], mimetype=XLSX_MIMETYPE)
+
+
+def export_filters():
+    # Общие фильтры выгрузок по классу: xlsx и csv
+    return {"subject": int(request.args.get("subject", 0)),
+            "year": int(request.args.get("year", current_year())),
+            "quarter": int(request.args.get("quarter", 0)),
+            "week": int(request.args.get("week", 0)),
+            "class_id": int(request.args.get("class_id", 0)),
+            "teacher": request_teacher_id()}
+
 
 @app.route("/export/teacher_xlsx")
+@role_required("teacher", "admin")
 def export_teacher_xlsx():
     # Учитель/Админ: выгрузка по классу (с фильтрами предмет/год/четверть/неделя)
-    if "user_id" not in session or session.get("role") not in ["teacher", "admin"]:
-        flash("Доступ только для учителей/админов", "danger")
-        return redirect(url_for("login"))
-
-    subject_id = int(request.args.get("subject", 0))
-    year = int(request.args.get("year", current_year()))
-    quarter = int(request.args.get("quarter", 0))
-    week = int(request.args.get("week", 0))
-    subject = Subject.query.get(subject_id) if subject_id != 0 else None
-    students = User.query.filter_by(role="student").all()
-
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Отчет класса"
-
-    ws.append(["ФИО ученика", "Предмет", "Период", "Неделя", "Оценки", "Средний балл"])
-
-    for st in students:
-        q = Grade.query.filter_by(student_id=st.id, year=year)
-        if quarter != 0:
-            q = q.filter_by(quarter=quarter)
-        if subject_id != 0:
-            q = q.filter_by(subject_id=subject_id)
-        if week != 0:
-            q = q.filter_by(week=week)
-        rows = q.all()
-        grades = [g.value for g in rows]
-        avg = round(sum(grades)/len(grades), 2) if grades else ""
-        subjname = subject.name if subject else "Все"
-        period_str = f"{year}, Q{quarter if quarter else '1-4'}"
-        week_str = week if week else "все"
-        ws.append([st.fullname or st.username, subjname, period_str, week_str, ";".join(map(str, grades)), avg])
-
-    autosize_columns(ws)
+    f = export_filters()
+    filename = f"teacher_report_{f['year']}_q{f['quarter']}_w{f['week']}.xlsx"
 
-    # Диаграмма по средним (колонка F)
-    data_start = 2
-    data_end = ws.max_row
-    if data_end >= data_start:
-        chart = BarChart()
-        chart.title = "Средний балл по ученикам"
-        values = Reference(ws, min_col=6, min_row=1, max_row=data_end)  # F1..F*
-        cats = Reference(ws, min_col=1, min_row=2, max_row=data_end)    # A2..A*
-        chart.add_data(values, titles_from_data=True)
-        chart.set_categories(cats)
-        chart.y_axis.title = "Средний балл"
-        chart.x_axis.title = "Ученик"
-        ws.add_chart(chart, "H2")
-
-    filepath = os.path.join(INSTANCE_DIR, f"teacher_report_{year}_q{quarter}_w{week}.xlsx")
-    wb.save(filepath)
-    return send_file(filepath, as_attachment=True)
+    if request.args.get("async"):
+        return start_export("teacher", f, filename)
+    buf = build_teacher_xlsx(f["subject"], f["year"], f["quarter"], f["week"], f["teacher"], f["class_id"])
+    return xlsx_response(buf, filename)
 
 
 @app.route("/export/student_xlsx")
+@role_required("student")
 def export_student_xlsx():
     # Студент: личный отчёт с диаграммой по предметам
-    if "user_id" not in session or session.get("role") != "student":
-        flash("Доступ только для студентов", "danger")
-        return redirect(url_for("login"))
-
-    student_id = session["user_id"]
     year = int(request.args.get("year", current_year()))
-    subjects = Subject.query.all()
-    subject_map = {s.id: s.name for s in subjects}
-
-    q = Grade.query.filter_by(student_id=student_id, year=year).all()
-    subj_avgs = {}
-    for g in q:
-        name = subject_map.get(g.subject_id, "Неизв.")
-        subj_avgs.setdefault(name, []).append(g.value)
+    buf = build_student_xlsx(current_user().id, year)
+    return xlsx_response(buf, f"student_report_{year}.xlsx")
+
+# ───────── CSV exports ─────────
+# Потоковые выгрузки для внешних систем: строки читаются из БД пачками
+# (yield_per — серверный курсор там, где он есть) и сразу уходят клиенту,
+# так что память не зависит от размера выгрузки. ?gzip=1 — файл .csv.gz.
+CSV_BATCH = int(os.environ.get("CSV_BATCH", 1000))
+
+
+def csv_chunks(header, rows, compress=False):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    gz = zlib.compressobj(wbits=31) if compress else None  # 31 — формат gzip
+
+    def take():
+        data = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+        return gz.compress(data) if gz else data
+
+    writer.writerow(header)
+    for n, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if n % CSV_BATCH == 0:
+            chunk = take()
+            if chunk:
+                yield chunk
+    yield take() + (gz.flush() if gz else b"")
+
+
+def csv_response(filename, header, rows):
+    compress = bool(request.args.get("gzip"))
+    if compress:
+        filename += ".gz"
+    response = Response(stream_with_context(csv_chunks(header, rows, compress)),
+                        mimetype="application/gzip" if compress else "text/csv")
+    if not compress:
+        response.charset = "utf-8"
+    response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+def stream_rows(query):
+    # Строки не ORM-объекты — loaded_as_persistent их не видит, считаем здесь
+    m = current_metrics()
+    for row in db.session.execute(query.execution_options(yield_per=CSV_BATCH)):
+        if m is not None:
+            m["rows"] += 1
+        yield tuple(row)
+
+
+def grade_csv_query(subject, year, quarter, week, teacher=None, class_id=0):
+    src = grade_table(year)
+    q = db.select(src.student_id, USER_DISPLAY_NAME, Subject.name,
+                  src.year, src.quarter, src.week, src.value) \
+        .join(User, User.id == src.student_id).join(Subject, Subject.id == src.subject_id) \
+        .where(src.year == year)
+    if subject:
+        q = q.where(src.subject_id == subject)
+    if quarter:
+        q = q.where(src.quarter == quarter)
+    if week:
+        q = q.where(src.week == week)
+    scope = teacher_student_ids(teacher, class_id, subject)
+    if scope is not None:
+        q = q.where(src.student_id.in_(scope))
+    return q.order_by(src.student_id, src.subject_id, src.quarter, src.week)
+
+
+def average_csv_query(subject, year, quarter, week, teacher=None, class_id=0):
+    aggs = grade_aggregate_query(year, subject_id=subject, quarters=[quarter] if quarter else None,
+                                 week=week, students=teacher_student_ids(teacher, class_id, subject)) \
+        .subquery()
+    return db.select(aggs.c.student_id, USER_DISPLAY_NAME, Subject.name, aggs.c.count, aggs.c.total) \
+        .join(User, User.id == aggs.c.student_id).join(Subject, Subject.id == aggs.c.subject_id) \
+        .order_by(aggs.c.student_id, aggs.c.subject_id)
+
+
+@app.route("/export/grades_csv")
+@role_required("teacher", "admin")
+def export_grades_csv():
+    # Все оценки по фильтрам, по строке на оценку
+    f = export_filters()
+    return csv_response(f"grades_{f['year']}_q{f['quarter']}_w{f['week']}.csv",
+                        ["student_id", "student", "subject", "year", "quarter", "week", "value"],
+                        stream_rows(grade_csv_query(**f)))
+
+
+@app.route("/export/averages_csv")
+@role_required("teacher", "admin")
+def export_averages_csv():
+    # Средний балл ученика по каждому предмету за выбранный период
+    f = export_filters()
+    # Среднее — тем же avg_of, что в отчётах и xlsx (округление SQL отличается)
+    rows = ((student_id, name, subject, count, avg_of(count, total))
+            for student_id, name, subject, count, total in stream_rows(average_csv_query(**f)))
+    return csv_response(f"averages_{f['year']}_q{f['quarter']}_w{f['week']}.csv",
+                        ["student_id", "student", "subject", "grades", "average"], rows)
+
+
+# ───────── Bulk import ─────────
+# Загрузка пользователей и оценок из CSV/xlsx (первая строка — заголовки):
+#   users:  username, password, role, fullname[, class]
+#   grades: username, subject, year, quarter, week, value
+# Файл читается построчно, строки проверяются и пишутся пачками по
+# IMPORT_BATCH в отдельных транзакциях. Ошибки копятся по номерам строк,
+# остальные строки загружаются.
+IMPORT_BATCH = int(os.environ.get("IMPORT_BATCH", 2000))
+USER_ROLES = ("student", "teacher", "admin")
+
+
+def cell_text(value):
+    # xlsx отдаёт числа как int/float: 5.0 → "5"
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def read_table(stream, filename):
+    # (номер строки в файле, {заголовок: значение}); пустые строки пропускаем
+    if filename.lower().endswith(".xlsx"):
+        from openpyxl import load_workbook
+        wb = load_workbook(stream, read_only=True, data_only=True)
+        rows = wb.active.iter_rows(values_only=True)
+    else:
+        text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+        first = text.readline()
+        # Excel с русской локалью сохраняет CSV через ";"
+        dialect = csv.Sniffer().sniff(first, delimiters=",;\t") if first.strip() else csv.excel
+        rows = csv.reader(itertools.chain([first], text), dialect)
+    header = [cell_text(h).lower() for h in next(rows, None) or []]
+    for n, row in enumerate(rows, start=2):
+        values = [cell_text(v) for v in row]
+        if any(values):
+            yield n, dict(zip(header, values))
+
+
+def import_report(kind):
+    return {"kind": kind, "rows": 0, "created": 0, "updated": 0, "unchanged": 0, "errors": []}
+
+
+def import_users(rows):
+    report = import_report("users")
+    seen, batch = set(), []
+    with ProcessPoolExecutor(max_workers=HASH_WORKERS) as pool:
+        for n, row in rows:
+            report["rows"] += 1
+            username, password = row.get("username", ""), row.get("password", "")
+            role = row.get("role", "").lower()
+            errors = []
+            if not username:
+                errors.append("пустой username")
+            elif username in seen:
+                errors.append("username повторяется в файле")
+            if len(password) <= 4:
+                errors.append("пароль короче 5 символов")
+            if role not in USER_ROLES:
+                errors.append(f"неверная роль «{role}»")
+            if errors:
+                report["errors"].append((n, "; ".join(errors)))
+                continue
+            seen.add(username)
+            batch.append((n, username, password, role, row.get("fullname", ""), row.get("class", "")))
+            if len(batch) >= IMPORT_BATCH:
+                insert_user_batch(batch, pool, report)
+                batch = []
+        insert_user_batch(batch, pool, report)
+    if report["created"]:
+        invalidate_user_reports(0)
+        grade_matrices.clear()
+    report["errors"].sort()
+    return report
+
+
+def insert_user_batch(batch, pool, report):
+    if not batch:
+        return
+    existing = set()
+    for chunk in chunked([username for _, username, *_ in batch]):
+        existing.update(u for (u,) in db.session.query(User.username).filter(User.username.in_(chunk)))
+    for n, username, *_ in batch:
+        if username in existing:
+            report["errors"].append((n, f"пользователь {username} уже существует"))
+    batch = [row for row in batch if row[1] not in existing]
+    if not batch:
+        return
+
+    # Хеш пароля — основная цена импорта; считаем на всех ядрах
+    hashes = pool.map(hash_password, [password for _, _, password, *_ in batch], chunksize=16)
+    db.session.execute(db.insert(User), [
+        {"username": username, "password_hash": pwhash, "role": role, "fullname": fullname}
+        for (_, username, _, role, fullname, _), pwhash in zip(batch, hashes)])
+
+    # Необязательная колонка class: ученики попадают в класс, недостающие классы создаются
+    by_class = {}
+    for _, username, _, role, _, class_name in batch:
+        if class_name and role == "student":
+            by_class.setdefault(class_name, []).append(username)
+    if by_class:
+        known = dict(db.session.query(SchoolClass.name, SchoolClass.id)
+                     .filter(SchoolClass.name.in_(list(by_class))))
+        missing = [name for name in by_class if name not in known]
+        if missing:
+            db.session.execute(db.insert(SchoolClass), [{"name": name} for name in missing])
+            known.update(db.session.query(SchoolClass.name, SchoolClass.id)
+                         .filter(SchoolClass.name.in_(missing)))
+        members = []
+        for class_name, usernames in by_class.items():
+            for chunk in chunked(usernames):
+                members += [{"class_id": known[class_name], "student_id": uid} for (uid,) in
+                            db.session.query(User.id).filter(User.username.in_(chunk))]
+        db.session.execute(db.insert(ClassStudent), members)
+    db.session.commit()
+    if by_class:
+        invalidate_class_reports()
+    report["created"] += len(batch)
+
+
+def parse_grade_row(row, subjects, locked=()):
+    # (значения для upsert_grades или None, список ошибок); locked — закрытые (год, четверть)
+    errors, values = [], {}
+    for field, low, high in (("year", 2000, current_year() + 1), ("quarter", 1, 4),
+                             ("week", 1, 53), ("value", 2, 5)):
+        try:
+            values[field] = int(row.get(field, ""))
+        except ValueError:
+            errors.append(f"{field}: не число")
+            continue
+        if not low <= values[field] <= high:
+            errors.append(f"{field}: вне {low}..{high}")
+    subject = row.get("subject", "")
+    values["subject_id"] = subjects.get(subject.lower())
+    if values["subject_id"] is None:
+        errors.append(f"неизвестный предмет «{subject}»")
+    if (values.get("year"), values.get("quarter")) in locked:
+        errors.append(f"{values['quarter']} четверть {values['year']} года закрыта")
+    if not row.get("username"):
+        errors.append("пустой username")
+    return (None if errors else values), errors
+
+
+def import_grades(rows):
+    report = import_report("grades")
+    subjects = {name.lower(): sid for sid, name in db.session.query(Subject.id, Subject.name)}
+    locked = locked_quarters()
+    batch = []
+    for n, row in rows:
+        report["rows"] += 1
+        values, errors = parse_grade_row(row, subjects, locked)
+        if errors:
+            report["errors"].append((n, "; ".join(errors)))
+            continue
+        batch.append((n, row["username"], values))
+        if len(batch) >= IMPORT_BATCH:
+            insert_grade_batch(batch, report)
+            batch = []
+    insert_grade_batch(batch, report)
+    report["errors"].sort()
+    return report
+
+
+def insert_grade_batch(batch, report):
+    if not batch:
+        return
+    students = {}
+    for chunk in chunked(list({username for _, username, _ in batch})):
+        students.update(db.session.query(User.username, User.id)
+                        .filter(User.username.in_(chunk), User.role == "student"))
+    grades, touched = [], {}
+    for n, username, values in batch:
+        student_id = students.get(username)
+        if student_id is None:
+            report["errors"].append((n, f"ученик {username} не найден"))
+            continue
+        grades.append(dict(values, student_id=student_id))
+        touched.setdefault((values["year"], values["quarter"], values["subject_id"]), set()).add(student_id)
+
+    with grade_writer():
+        stats = upsert_grades(grades)
+        db.session.commit()
+    report["created"] += stats["inserted"]
+    report["updated"] += stats["updated"]
+    report["unchanged"] += stats["skipped"]
+    for (year, quarter, subject_id), student_ids in touched.items():
+        invalidate_grade_reports(year, quarter, subject_id, student_ids)
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = f"Отчёт {year}"
 
-    ws.append(["Предмет", "Средний балл"])
-    for s in subjects:
-        vals = subj_avgs.get(s.name, [])
-        avg = round(sum(vals)/len(vals), 2) if vals else 0
-        ws.append([s.name, avg])
+IMPORTERS = {"users": import_users, "grades": import_grades}
 
-    autosize_columns(ws)
 
-    # Диаграмма по предметам
-    data_end = ws.max_row
-    if data_end >= 2:
-        chart = BarChart()
-        chart.title = "Средний балл по предметам"
-        values = Reference(ws, min_col=2, min_row=1, max_row=data_end)
-        cats = Reference(ws, min_col=1, min_row=2, max_row=data_end)
-        chart.add_data(values, titles_from_data=True)
-        chart.set_categories(cats)
-        chart.y_axis.title = "Средний балл"
-        chart.x_axis.title = "Предмет"
-        ws.add_chart(chart, "E2")
+@app.route("/admin/import", methods=["GET", "POST"])
+@role_required("admin")
+def admin_import():
+    report = None
+    if request.method == "POST":
+        kind = request.form.get("kind")
+        upload = request.files.get("file")
+        if kind not in IMPORTERS or not upload or not upload.filename:
+            flash("Выберите тип импорта и файл", "danger")
+        else:
+            try:
+                report = IMPORTERS[kind](read_table(upload.stream, upload.filename))
+            except (csv.Error, UnicodeDecodeError, zipfile.BadZipFile) as e:
+                db.session.rollback()
+                flash(f"Не удалось прочитать файл: {e}", "danger")
+    return render_template("admin_import.html", report=report)
 
-    filepath = os.path.join(INSTANCE_DIR, f"student_report_{year}.xlsx")
-    wb.save(filepath)
-    return send_file(filepath, as_attachment=True)
 
 # ───────── Admin ─────────
 @app.route("/admin", methods=["GET", "POST"])
+@role_required("admin")
 def admin_page():
-    if "user_id" not in session or session.get("role") != "admin":
-        flash("Доступ только для админов", "danger")
-        return redirect(url_for("login"))
-
     message = ""
     if request.method == "POST":
         username = request.form["username"].strip()
@@ -458,35 +2816,41 @@ def admin_page():
             else:
                 u = User(
                     username=username,
-                    password_hash=generate_password_hash(password),
+                    password_hash=hash_password(password),
                     role=role,
                     fullname=fullname
                 )
                 db.session.add(u)
                 db.session.commit()
+                if u.role == "student":
+                    invalidate_user_reports(u.id)  # новый ученик появляется в отчётах
+                    grade_matrices.clear()
                 message = "Пользователь создан"
                 flash(message, "success")
         else:
             message = "Неверные данные (пароль >4 символов, корректная роль)"
             flash(message, "danger")
 
-    users = User.query.all()
-    return render_template("admin.html", users=users, message=message)
+    order = request.args.get("order", "id")
+    role_filter = request.args.get("role", "")
+    query = filter_users(User.query, request.args.get("q", "").strip(), role_filter)
+    users, next_cursor = keyset_page(query, order, request.args.get("after"))
+    return render_template("admin.html", users=users, message=message,
+                           next_cursor=next_cursor, order=order, role_filter=role_filter,
+                           page_args=page_args("q", "order", "role"))
 
 
 # ───────── Admin: редактирование пользователя ─────────
 @app.route("/edit_user/<int:user_id>", methods=["POST"])
+@role_required("admin")
 def edit_user(user_id):
-    if "user_id" not in session or session.get("role") != "admin":
-        flash("Доступ только для админов", "danger")
-        return redirect(url_for("login"))
-
     user = User.query.get_or_404(user_id)
 
     username = request.form.get("username", "").strip()
     fullname = request.form.get("fullname", "").strip()
     role = request.form.get("role", "").strip()
     password = request.form.get("password", "").strip()
+    before = (user.username, user.fullname, user.role)
 
     if username:
         user.username = username
@@ -494,20 +2858,26 @@ def edit_user(user_id):
     if role in ["student", "teacher", "admin"]:
         user.role = role
     if password and len(password) > 4:
-        user.password_hash = generate_password_hash(password)
+        user.password_hash = hash_password(password)
 
+    if (user.username, user.fullname, user.role) != before:
+        # В той же транзакции: другие воркеры увидят новую роль вместе с версией
+        bump_data_versions(["users"])
     db.session.commit()
+    if (user.username, user.fullname, user.role) != before:
+        # Новая роль/имя действуют сразу, без повторного входа
+        user_cache.invalidate(user.id)
+        invalidate_user_reports(user.id)
+    if user.role != before[2]:
+        grade_matrices.clear()
     flash("Пользователь обновлён", "success")
     return redirect(url_for("admin_page"))
 
 
 # ───────── Admin: удаление пользователя ─────────
 @app.route("/delete_user/<int:user_id>", methods=["POST"])
+@role_required("admin")
 def delete_user(user_id):
-    if "user_id" not in session or session.get("role") != "admin":
-        flash("Доступ только для админов", "danger")
-        return redirect(url_for("login"))
-
     user = User.query.get_or_404(user_id)
 
     # Защита — нельзя удалить администратора
@@ -515,160 +2885,478 @@ def delete_user(user_id):
         flash("Нельзя удалить администратора!", "danger")
         return redirect(url_for("admin_page"))
 
-    db.session.delete(user)
-    db.session.commit()
+    # Оценки — одним DELETE на таблицу (горячую и архив), вместе с роллапами и итогами;
+    # удалённые оценки попадают в журнал изменений
+    with grade_writer():
+        for src in GRADE_TABLES:
+            log_grade_deletes(src, src.student_id == user.id)
+            db.session.execute(db.delete(src).where(src.student_id == user.id))
+        GradeRollup.query.filter_by(student_id=user.id).delete()
+        QuarterMark.query.filter_by(student_id=user.id).delete()
+        ClassStudent.query.filter_by(student_id=user.id).delete()
+        TeachingAssignment.query.filter_by(teacher_id=user.id).delete()
+        db.session.delete(user)
+        bump_data_versions(["users"])  # сессии удалённого сбрасываются во всех воркерах
+        db.session.commit()
+    user_cache.invalidate(user_id)
+    invalidate_user_reports(user_id)
+    grade_matrices.clear()
     flash("Пользователь удалён", "info")
     return redirect(url_for("admin_page"))
 
 
-    if "user_id" not in session or session.get("role") != "admin":
-        flash("Доступ только для админов", "danger")
-        return redirect(url_for("login"))
-
-    message = ""
-    if request.method == "POST":
-        username = request.form["username"].strip()
-        fullname = request.form.get("fullname", "").strip()
-        password = request.form["password"].strip()
-        role = request.form["role"]
-        if username and password and len(password) > 4 and role in ["student", "teacher", "admin"]:
-            if User.query.filter_by(username=username).first():
-                message = "Пользователь с таким логином уже существует"
-                flash(message, "danger")
-            else:
-                u = User(username=username,
-                         password_hash=generate_password_hash(password),
-                         role=role, fullname=fullname)
-                db.session.add(u)
-                db.session.commit()
-                message = "Пользователь создан"
-                flash(message, "success")
-        else:
-            message = "Неверные данные (пароль >4 символов, корректная роль)"
-            flash(message, "danger")
+def admin_report_data(year, subjects):
+    subject_map = {s.id: s.name for s in subjects}
+    m = grade_matrices.get(year)
+    counts, totals = m.sums()
+    names = [subject_map.get(int(sid), "Неизвестный") for sid in m.subject_ids]
+    # Списки Python по строкам: средние считаем тем же avg_of, что и раньше
+    counts, totals = counts.tolist(), totals.tolist()
 
-    users = User.query.all()
-    return render_template("admin.html", users=users, message=message)
+    report_data = []
+    for st_id, fullname, username in student_rows():
+        i = m.index.get(st_id)
+        st_counts, st_totals = (counts[i], totals[i]) if i is not None else ([], [])
+        report_data.append({
+            "student": fullname or username,
+            "subj_avgs": {name: avg_of(c, t)
+                          for name, c, t in zip(names, st_counts, st_totals) if c},
+            "overall": avg_of(sum(st_counts), sum(st_totals))
+        })
+    return report_data
 
 
 @app.route("/admin/reports")
+@role_required("admin")
 def admin_reports():
-    if "user_id" not in session or session.get("role") != "admin":
-        flash("Доступ только для админов", "danger")
-        return redirect(url_for("login"))
-
     year = int(request.args.get("year", current_year()))
     if year < 2000 or year > current_year() + 1:
         year = current_year()
         flash("Год исправлен на текущий", "info")
 
-    students = User.query.filter_by(role="student").all()
     subjects = Subject.query.all()
     if not subjects:
         flash("Нет предметов в базе. Запустите инициализацию БД.", "danger")
         return redirect(url_for("admin_page"))
 
-    subject_map = {s.id: s.name for s in subjects}
-    report_data = []
-    for st in students:
-        q = Grade.query.filter_by(student_id=st.id, year=year).all()
-        subj_avgs = {}
-        for g in q:
-            subjname = subject_map.get(g.subject_id, "Неизвестный")
-            subj_avgs.setdefault(subjname, []).append(g.value)
-        subj_avgs = {k: round(sum(v)/len(v), 2) if v else 0 for k, v in subj_avgs.items()}
-        overall_avg = round(sum([g.value for g in q])/len(q), 2) if q else 0
-        report_data.append({
-            "student": st.fullname or st.username,
-            "subj_avgs": subj_avgs,
-            "overall": overall_avg
-        })
+    report_key = ReportKey("admin_reports", year, "year", 0, 0)
+    report_data = cached_report(report_key, lambda: admin_report_data(year, subjects))
 
     return render_template("admin_reports.html",
                            year=year,
                            report_data=report_data,
-                           total_students=len(students),
+                           report_key=report_key,
+                           total_students=len(report_data),
                            subjects=subjects)
 
 
+# ───────── Admin: закрытие четвертей ─────────
+@app.route("/admin/quarters", methods=["GET", "POST"])
+@role_required("admin")
+def admin_quarters():
+    year = int(request.values.get("year", current_year()))
+    if request.method == "POST":
+        try:
+            quarter = int(request.form["quarter"])
+            if request.form.get("action") == "reopen":
+                reopen_quarter(year, quarter)
+                flash(f"{quarter} четверть {year} года снова открыта для изменений", "info")
+            else:
+                rows = close_quarter(year, quarter)
+                flash(f"{quarter} четверть {year} года закрыта, итоговых оценок: {rows}", "success")
+        except ValueError as e:
+            flash(str(e), "danger")
+        return redirect(url_for("admin_quarters", year=year))
+
+    closed = dict(db.session.query(ClosedQuarter.quarter, ClosedQuarter.rows).filter_by(year=year))
+    return render_template("admin_quarters.html", year=year, closed=closed,
+                           archived=year in archived_years())
+
+
+# ───────── Admin: аналитика по школе ─────────
+# Всё считается несколькими агрегатами на стороне БД, без запросов на ученика:
+# распределение оценок — GROUP BY по Grade, тренды и средние — по итогам
+# четвертей (mark_source), ранги — оконные функции над средними учеников.
+# Все виджеты считают одних и тех же учеников — с ролью student сейчас.
+ANALYTICS_TOP = int(os.environ.get("ANALYTICS_TOP", 20))
+
+
+def analytics_students():
+    return db.select(User.id).where(User.role == "student")
+
+
+def ranked_students(year, quarters):
+    # Средний балл ученика за период, место в школе и процентильный ранг (0..1)
+    src = mark_source(year, quarters).c
+    avg = (func.sum(src.total) * 1.0 / func.sum(src.count)).label("avg")
+    avgs = db.select(src.student_id, avg).where(
+        src.count > 0, src.student_id.in_(analytics_students())
+    ).group_by(src.student_id).subquery()
+    return db.select(
+        avgs.c.student_id, avgs.c.avg,
+        func.rank().over(order_by=avgs.c.avg.desc()).label("rank"),
+        func.percent_rank(type_=db.Float).over(order_by=avgs.c.avg).label("pct"),
+        func.count().over().label("graded"),
+    ).subquery()
+
+
+def analytics_data(year, period, subjects):
+    quarters = period_quarters(period)
+
+    # Сколько каких оценок по каждому предмету
+    histograms = {}
+    src = grade_table(year)
+    q = db.session.query(src.subject_id, src.value, func.count()).filter(
+        src.year == year, src.quarter.in_(quarters), src.student_id.in_(analytics_students())
+    ).group_by(src.subject_id, src.value)
+    for subject_id, value, n in q:
+        histograms.setdefault(subject_id, {})[str(value)] = n
+
+    # Средние по четвертям всего года — для трендов, независимо от периода
+    sums = {}
+    marks = mark_source(year).c
+    q = db.session.query(marks.subject_id, marks.quarter,
+                         func.sum(marks.count), func.sum(marks.total)).filter(
+        marks.count > 0, marks.student_id.in_(analytics_students())
+    ).group_by(marks.subject_id, marks.quarter)
+    for subject_id, quarter, count, total in q:
+        sums[subject_id, quarter] = (count, total)
+
+    def trend(subject_ids):
+        out = []
+        for quarter in range(1, 5):
+            count = sum(sums.get((sid, quarter), (0, 0))[0] for sid in subject_ids)
+            total = sum(sums.get((sid, quarter), (0, 0))[1] for sid in subject_ids)
+            out.append(avg_of(count, total, empty=None))
+        return out
+
+    def period_avg(subject_ids):
+        count = sum(sums.get((sid, q), (0, 0))[0] for sid in subject_ids for q in quarters)
+        total = sum(sums.get((sid, q), (0, 0))[1] for sid in subject_ids for q in quarters)
+        return avg_of(count, total, empty=None)
+
+    # Топ и группа риска — одним проходом оконных функций по всей школе
+    ranked = ranked_students(year, quarters)
+    q = db.select(ranked, USER_DISPLAY_NAME.label("name")) \
+        .join(User, User.id == ranked.c.student_id) \
+        .where(or_(ranked.c.rank <= ANALYTICS_TOP, ranked.c.avg < RISK_THRESHOLD)) \
+        .order_by(ranked.c.rank, User.id)
+    top, at_risk, graded = [], [], 0
+    for r in db.session.execute(q):
+        graded = r.graded
+        row = {"student_id": r.student_id, "name": r.name, "avg": round(r.avg, 2), "rank": r.rank,
+               "percentile": round(r.pct * 100, 1)}
+        if r.rank <= ANALYTICS_TOP:
+            top.append(row)
+        if r.avg < RISK_THRESHOLD:
+            at_risk.append(row)
+    at_risk.sort(key=lambda row: (-row["rank"], row["student_id"]))  # худшие первыми
+
+    subject_ids = [s.id for s in subjects]
+    return {
+        "year": year, "period": period, "quarters": quarters,
+        "risk_threshold": RISK_THRESHOLD, "graded_students": graded,
+        "school": {"average": period_avg(subject_ids), "trend": trend(subject_ids)},
+        "subjects": [{"id": s.id, "name": s.name, "average": period_avg([s.id]),
+                      "trend": trend([s.id]),
+                      "histogram": {str(v): histograms.get(s.id, {}).get(str(v), 0) for v in range(2, 6)}}
+                     for s in subjects],
+        "top": top,
+        "at_risk": at_risk,
+    }
+
+
+@app.route("/admin/analytics")
+@role_required("admin", api=wants_json)
+def admin_analytics():
+    year = int(request.args.get("year", current_year()))
+    period = request.args.get("period", "year")  # quarter1..4, halfyear1/2, year
+    subjects = Subject.query.order_by(Subject.id).all()
+    data = cached_report(ReportKey("admin_analytics", year, period, 0, 0),
+                         lambda: analytics_data(year, period, subjects))
+
+    if wants_json():
+        # Клиент может сам кэшировать и строить графики
+        response = make_response(data)
+        response.headers["Cache-Control"] = "private, max-age=60"
+        return response
+    return render_template("admin_analytics.html", data=data, year=year, period=period)
+
+
+# ───────── Admin: классы и назначения учителей ─────────
+@app.route("/admin/classes", methods=["GET", "POST"])
+@role_required("admin")
+def admin_classes():
+    if request.method == "POST":
+        action = request.form.get("action")
+        class_id = int(request.form.get("class_id", 0))
+
+        if action == "create":
+            name = request.form.get("name", "").strip()
+            if not name or SchoolClass.query.filter_by(name=name).first():
+                flash("Пустое или занятое название класса", "danger")
+            else:
+                db.session.add(SchoolClass(name=name))
+                db.session.commit()
+                flash(f"Класс {name} создан", "success")
+
+        elif action == "add_students":
+            # Логины через пробел/запятую/перевод строки
+            names = [n for n in re.split(r"[\s,;]+", request.form.get("usernames", "")) if n]
+            found = {}
+            for chunk in chunked(names):
+                found.update(db.session.query(User.username, User.id)
+                             .filter(User.username.in_(chunk), User.role == "student"))
+            existing = {sid for (sid,) in db.session.query(ClassStudent.student_id)
+                        .filter_by(class_id=class_id)}
+            new_ids = set(found.values()) - existing
+            db.session.add_all([ClassStudent(class_id=class_id, student_id=sid) for sid in new_ids])
+            db.session.commit()
+            invalidate_class_reports()
+            missing = [n for n in names if n not in found]
+            flash(f"Добавлено учеников: {len(new_ids)}"
+                  + (f"; не найдены: {', '.join(missing)}" if missing else ""),
+                  "success" if not missing else "info")
+
+        elif action == "remove_student":
+            ClassStudent.query.filter_by(class_id=class_id,
+                                         student_id=int(request.form["student_id"])).delete()
+            db.session.commit()
+            invalidate_class_reports()
+            flash("Ученик убран из класса", "success")
+
+        elif action == "assign":
+            key = dict(teacher_id=int(request.form["teacher_id"]), class_id=class_id,
+                       subject_id=int(request.form["subject_id"]))
+            teacher = db.session.get(User, key["teacher_id"])
+            if not teacher or teacher.role != "teacher" or not db.session.get(Subject, key["subject_id"]):
+                flash("Неверный учитель или предмет", "danger")
+            elif not db.session.get(TeachingAssignment, tuple(key.values())):
+                db.session.add(TeachingAssignment(**key))
+                db.session.commit()
+                invalidate_class_reports()
+                flash("Назначение добавлено", "success")
+
+        elif action == "unassign":
+            TeachingAssignment.query.filter_by(teacher_id=int(request.form["teacher_id"]),
+                                               class_id=class_id,
+                                               subject_id=int(request.form["subject_id"])).delete()
+            db.session.commit()
+            invalidate_class_reports()
+            flash("Назначение снято", "success")
+
+        elif action == "delete":
+            ClassStudent.query.filter_by(class_id=class_id).delete()
+            TeachingAssignment.query.filter_by(class_id=class_id).delete()
+            SchoolClass.query.filter_by(id=class_id).delete()
+            db.session.commit()
+            invalidate_class_reports()
+            flash("Класс удалён", "success")
+
+        return redirect(url_for("admin_classes", class_id=class_id or None))
+
+    classes = SchoolClass.query.order_by(SchoolClass.name).all()
+    # Размер классов одним GROUP BY
+    sizes = dict(db.session.query(ClassStudent.class_id, func.count())
+                 .group_by(ClassStudent.class_id).all())
+    selected = db.session.get(SchoolClass, int(request.args.get("class_id", 0)))
+
+    members, assignments = [], []
+    if selected:
+        members = User.query.join(ClassStudent, ClassStudent.student_id == User.id) \
+            .filter(ClassStudent.class_id == selected.id).order_by(USER_DISPLAY_NAME, User.id).all()
+        assignments = db.session.query(User, Subject) \
+            .join(TeachingAssignment, TeachingAssignment.teacher_id == User.id) \
+            .join(Subject, Subject.id == TeachingAssignment.subject_id) \
+            .filter(TeachingAssignment.class_id == selected.id) \
+            .order_by(USER_DISPLAY_NAME, Subject.id).all()
+
+    return render_template("admin_classes.html", classes=classes, sizes=sizes, selected=selected,
+                           members=members, assignments=assignments,
+                           teachers=User.query.filter_by(role="teacher").order_by(User.id).all(),
+                           subjects=Subject.query.all())
+
+
+@app.route("/admin/login_stats")
+@role_required("admin", api=True)
+def admin_login_stats():
+    # Задержка входа: БД отдельно от проверки хеша
+    return login_stats.stats()
+
+
+@app.route("/admin/metrics")
+@role_required("admin", api=True)
+def admin_metrics():
+    # Сводка по endpoint'ам (нужен METRICS=1)
+    return {"enabled": METRICS_ENABLED, "query_threshold": METRICS_QUERY_THRESHOLD,
+            "endpoints": endpoint_metrics.stats()}
+
+
+@app.route("/admin/cache")
+@role_required("admin", api=True)
+def admin_cache_stats():
+    # Счётчики кэша отчётов и фрагментов — чтобы подобрать REPORT_CACHE_SIZE/FRAGMENT_CACHE_SIZE
+    return dict(report_cache.stats(), fragments=fragment_cache.stats())
+
+
+@app.route("/admin/matrix")
+@role_required("admin", api=True)
+def admin_matrix():
+    # Матрица оценок года: размер в памяти и время расчёта аналитики по ней
+    year = int(request.args.get("year", current_year()))
+    quarters = period_quarters(request.args.get("period", "year"))
+    m = grade_matrices.get(year)
+    started = time.perf_counter()
+    result = {
+        "subject_averages": m.subject_averages(quarters),
+        "distribution": m.distribution(quarters),
+        "at_risk": len(m.at_risk(quarters)),
+        "median_percentile": float(np.nanmedian(m.percentiles(quarters))) if len(m.student_ids) else None,
+    }
+    result["compute_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return {"year": year, "store": grade_matrices.stats(), **result}
+
+
 # ───────── Admin: экспорт отчёта в Excel ─────────
 @app.route("/export/admin_xlsx")
+@role_required("admin")
 def export_admin_xlsx():
     # Админ: сводная по ученикам/предметам (средние за год)
-    if "user_id" not in session or session.get("role") != "admin":
-        flash("Доступ только для админов", "danger")
-        return redirect(url_for("login"))
+    year = int(request.args.get("year", current_year()))
+    filename = f"admin_report_{year}.xlsx"
+
+    if request.args.get("async"):
+        return start_export("admin", {"year": year}, filename)
+    buf = build_admin_xlsx(year)
+    return xlsx_response(buf, filename)
 
+
+    
+# ───────── Admin Dashboard ─────────
+@app.route("/admin/dashboard")
+@role_required("admin")
+def admin_dashboard():
+    return render_template("admin_dashboard.html")
+
+
+# ───────── JSON API v1 ─────────
+# Те же данные, что на страницах, без рендера шаблонов. ETag строится из версий
+# данных (см. DataVersion), поэтому опрос без изменений отвечает 304 после одного
+# лёгкого запроса к БД — сами отчёты не считаются и не сериализуются.
+API_VERSION = 1
+
+
+def api_response(scopes, compute):
+    # Версии scopes + адрес запроса + пользователь → ETag; If-None-Match → 304
+    tag = json.dumps([API_VERSION, request.full_path, current_user().id,
+                      scopes, data_versions(scopes)], ensure_ascii=False)
+    etag = hashlib.sha1(tag.encode("utf-8")).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(compute())
+    response.set_etag(etag)
+    # Клиент всегда перепроверяет, но тело при совпадении не качает
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@app.route("/api/v1/student/grades")
+@role_required("student", api=True)
+def api_student_grades():
+    student_id = current_user().id
     year = int(request.args.get("year", current_year()))
-    students = User.query.filter_by(role="student").all()
-    subjects = Subject.query.all()
-    subject_map = {s.id: s.name for s in subjects}
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = f"Итоги {year}"
+    def compute():
+        subject_map = {s.id: s.name for s in Subject.query.all()}
+        src = grade_table(year)
+        grades = db.session.query(src.subject_id, src.value, src.quarter, src.week) \
+            .filter_by(student_id=student_id, year=year).order_by(src.id)
+        aggs = grade_aggregates(year, student_id=student_id).get(student_id, {})
+        return {"year": year,
+                "grades": [{"subject_id": subject_id, "subject": subject_map.get(subject_id, ""),
+                            "value": value, "quarter": quarter, "week": week}
+                           for subject_id, value, quarter, week in grades],
+                "averages": {subject_map.get(subject_id, ""): avg_of(count, total)
+                             for subject_id, (count, total) in aggs.items()}}
+
+    return api_response([f"student:{student_id}"], compute)
+
+
+@app.route("/api/v1/student/report")
+@role_required("student", api=True)
+def api_student_report():
+    student_id = current_user().id
+    year = int(request.args.get("year", current_year()))
 
-    # Заголовки
-    headers = ["Ученик"] + [s.name for s in subjects] + ["Общий средний"]
-    ws.append(headers)
+    def compute():
+        subj_avgs, overall = cached_report(
+            ReportKey("student_report", year, "year", 0, student_id),
+            lambda: student_report_data(student_id, year, Subject.query.all()))
+        return {"year": year, "subject_avgs": subj_avgs, "overall_avg": overall}
 
-    # Данные
-    for st in students:
-        q = Grade.query.filter_by(student_id=st.id, year=year).all()
-        subj_avgs = {}
-        for g in q:
-            name = subject_map.get(g.subject_id, "Неизв.")
-            subj_avgs.setdefault(name, []).append(g.value)
+    return api_response([f"student:{student_id}"], compute)
 
-        row = [st.fullname or st.username]
-        vals_for_mean = []
-        for s in subjects:
-            vals = subj_avgs.get(s.name, [])
-            avg = round(sum(vals)/len(vals), 2) if vals else ""
-            row.append(avg)
-            if isinstance(avg, (int, float)):
-                vals_for_mean.append(avg)
-
-        overall = round(sum(vals_for_mean)/len(vals_for_mean), 2) if vals_for_mean else ""
-        row.append(overall)
-        ws.append(row)
 
-    # Автоширина
-    for col in ws.columns:
-        max_len = 0
-        col_letter = get_column_letter(col[0].column)
-        for cell in col:
-            max_len = max(max_len, len(str(cell.value)) if cell.value else 0)
-        ws.column_dimensions[col_letter].width = max(12, min(40, max_len + 2))
+@app.route("/api/v1/teacher/report")
+@role_required("teacher", api=True)
+def api_teacher_report():
+    teacher_id = current_user().id
+    subject_id = int(request.args.get("subject", 0))
+    year = int(request.args.get("year", current_year()))
+    period = request.args.get("period", "year")
+    class_id = int(request.args.get("class_id", 0))
 
-    # Диаграмма по общему среднему
-    last_col = ws.max_column
-    data_end = ws.max_row
-    if data_end >= 2:
-        chart = BarChart()
-        chart.title = "Общий средний балл (по ученикам)"
-        values = Reference(ws, min_col=last_col, min_row=1, max_row=data_end)
-        cats = Reference(ws, min_col=1, min_row=2, max_row=data_end)
-        chart.add_data(values, titles_from_data=True)
-        chart.set_categories(cats)
-        chart.y_axis.title = "Средний балл"
-        chart.x_axis.title = "Ученик"
-        ws.add_chart(chart, f"{get_column_letter(last_col+2)}2")
+    def compute():
+        rows = cached_report(
+            ReportKey("teacher_report", year, period, subject_id, (teacher_id, class_id)),
+            lambda: teacher_report_data(year, period, subject_id, teacher_id, class_id))
+        return {"year": year, "period": period, "subject_id": subject_id, "class_id": class_id,
+                "students": [{"name": name, "grades": grades, "avg": avg}
+                             for name, grades, avg in rows]}
 
-    filepath = os.path.join(INSTANCE_DIR, f"admin_report_{year}.xlsx")
-    wb.save(filepath)
-    return send_file(filepath, as_attachment=True)
+    return api_response([f"grades:{year}", "users"], compute)
 
 
-    
-# ───────── Admin Dashboard ─────────
-@app.route("/admin/dashboard")
-def admin_dashboard():
-    if "user_id" not in session or session.get("role") != "admin":
-        flash("Доступ только для админов", "danger")
-        return redirect(url_for("login"))
+@app.route("/api/v1/admin/report")
+@role_required("admin", api=True)
+def api_admin_report():
+    year = int(request.args.get("year", current_year()))
 
-    return render_template("admin_dashboard.html")
+    def compute():
+        subjects = Subject.query.all()
+        rows = cached_report(ReportKey("admin_reports", year, "year", 0, 0),
+                             lambda: admin_report_data(year, subjects))
+        return {"year": year, "subjects": [s.name for s in subjects], "students": rows}
+
+    return api_response([f"grades:{year}", "users"], compute)
+
+
+@app.route("/api/v1/grades/changes")
+@role_required("admin", api=True)
+def api_grade_changes():
+    # Лента изменений: ?after=<seq> — последний обработанный seq, ответ — следующая
+    # страница и курсор next. Первая синхронизация: запомнить latest, снять полную
+    # выгрузку и дальше читать с after=latest (повтор изменений безопасен — у каждого
+    # полное новое значение ячейки).
+    after = int(request.args.get("after", 0))
+    limit = max(1, min(int(request.args.get("limit", CHANGES_PAGE_SIZE)), CHANGES_PAGE_SIZE))
+    rows, has_more = grade_changes_since(after, limit)
+    subject_map = {s.id: s.name for s in Subject.query.all()}
+    latest = latest_change_seq()
+    response = make_response({
+        "changes": [{"seq": c.seq, "op": c.op, "student_id": c.student_id, "username": username,
+                     "subject_id": c.subject_id, "subject": subject_map.get(c.subject_id, ""),
+                     "year": c.year, "quarter": c.quarter, "week": c.week,
+                     "value": c.value, "old_value": c.old_value,
+                     "changed_at": c.changed_at.isoformat(timespec="seconds"), "actor_id": c.actor_id}
+                    for c, username in rows],
+        "next": rows[-1][0].seq if rows else after,
+        "has_more": has_more,
+        "latest": latest,
+    })
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 
 from datetime import datetime
@@ -695,13 +3383,112 @@ def datetime_format(value, format="%d.%m.%Y %H:%M"):
 
 
 
+# ───────── App factory ─────────
+# Вход для WSGI-сервера с несколькими воркерами (wsgi.py, gunicorn.conf.py).
+# Маршруты живут на модульном app, поэтому фабрика не строит новый объект,
+# а настраивает его из окружения. Сервер вызывает её один раз в мастере до
+# fork: воркеры получают готовое приложение и прогретые модули общими
+# (copy-on-write) страницами памяти, а не импортируют их каждый сам.
+PRELOAD_MODULES = ("numpy", "openpyxl", "openpyxl.chart", "openpyxl.utils")
+
+
+def create_app(config=None):
+    # FLASK_<КЛЮЧ> из окружения (например FLASK_SESSION_COOKIE_SECURE=true), затем config
+    app.config.from_prefixed_env()
+    if config:
+        app.config.update(config)
+    if app.config["SECRET_KEY"] == "dev-only-CHANGE-ME" and not app.debug and not app.testing:
+        raise RuntimeError("SECRET_KEY не задан: установите переменную окружения SECRET_KEY")
+    # Схему обновляет отдельный шаг деплоя (python app.py migrate); при старте — по желанию
+    if os.environ.get("MIGRATE_ON_START", "0") == "1":
+        with app.app_context():
+            migrate_db()
+    if os.environ.get("PRELOAD", "1") == "1":
+        preload()
+    return app
+
+
+def preload():
+    # То, что иначе каждый воркер делал бы сам при первых запросах:
+    # ленивые модули, префикс хеша паролей, компиляция шаблонов
+    for name in PRELOAD_MODULES:
+        # vars(): модуль от lazy_import выполняется при первом доступе к атрибуту
+        vars(importlib.import_module(name))
+    hash_prefix()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def after_fork():
+    # В воркере: соединения с БД, открытые мастером, не используем (как в _export_worker_init)
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
 # ───────── CLI ─────────
+def cli_option(name, default):
+    # --name N или --name=N из командной строки
+    for i, arg in enumerate(sys.argv):
+        if arg == f"--{name}" and i + 1 < len(sys.argv):
+            return type(default)(sys.argv[i + 1])
+        if arg.startswith(f"--{name}="):
+            return type(default)(arg.split("=", 1)[1])
+    return default
+
+
 if __name__ == "__main__":
-    import sys
     with app.app_context():
-        db.create_all()
+        created = migrate_db()
+    if created:
+        print("Indexes created:", ", ".join(created))
     if "initdb" in sys.argv:
         with app.app_context():
             create_demo_data()
+    elif "gendata" in sys.argv:
+        # python app.py gendata --students 2000 --subjects 10 --years 1 --weeks 10
+        with app.app_context():
+            create_large_data(students=cli_option("students", 2000), subjects=cli_option("subjects", 10),
+                              years=cli_option("years", 1), weeks=cli_option("weeks", 10),
+                              class_size=cli_option("class-size", 30), seed=cli_option("seed", 1))
+    elif "import" in sys.argv:
+        # python app.py import users users.csv | python app.py import grades grades.xlsx
+        args = sys.argv[sys.argv.index("import") + 1:]
+        if len(args) != 2 or args[0] not in IMPORTERS:
+            sys.exit("usage: python app.py import users|grades FILE")
+        kind, path = args
+        with app.app_context(), open(path, "rb") as f:
+            report = IMPORTERS[kind](read_table(f, path))
+        for n, error in report["errors"]:
+            print(f"  row {n}: {error}")
+        print(f"Rows: {report['rows']}, created: {report['created']}, updated: {report['updated']}, "
+              f"unchanged: {report['unchanged']}, errors: {len(report['errors'])}")
+        sys.exit(1 if report["errors"] else 0)
+    elif "archive" in sys.argv or "restore" in sys.argv:
+        # python app.py archive 2023 | python app.py restore 2023
+        command = "archive" if "archive" in sys.argv else "restore"
+        args = sys.argv[sys.argv.index(command) + 1:]
+        if len(args) != 1 or not args[0].isdigit():
+            sys.exit(f"usage: python app.py {command} YEAR")
+        with app.app_context():
+            try:
+                moved = (archive_year if command == "archive" else restore_year)(int(args[0]))
+            except ValueError as e:
+                sys.exit(str(e))
+            print(f"{command}: {moved} grades moved, archived years: {sorted(archived_years())}")
+    elif "migrate" in sys.argv:
+        print("Database schema is up to date")
+    elif "check-rollups" in sys.argv or "rebuild-rollups" in sys.argv:
+        with app.app_context():
+            mismatches = check_rollups()
+            for key, actual, expected in mismatches[:20]:
+                print(f"  {key}: rollup={actual} grades={expected}")
+            print(f"Rollup mismatches: {len(mismatches)}")
+            if "rebuild-rollups" in sys.argv:
+                rebuild_rollups()
+                mismatches = check_rollups()
+                print(f"Rollups rebuilt, mismatches after rebuild: {len(mismatches)}")
+        sys.exit(1 if mismatches else 0)
     else:
-        app.run(host="0.0.0.0", port=5000, debug=True)
+        # Сервер разработки; в продакшене — gunicorn -c gunicorn.conf.py wsgi:app
+        app.run(host=os.environ.get("HOST", "0.0.0.0"), port=int(os.environ.get("PORT", 5000)),
+                debug=os.environ.get("FLASK_DEBUG", "1") == "1")
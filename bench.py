@@ -0,0 +1,172 @@
+# bench.py — замеры основных страниц и выгрузок через тестовый клиент Flask.
+#
+#   DATABASE_URL=sqlite:///bench.db python app.py gendata --students 2000
+#   DATABASE_URL=sqlite:///bench.db python bench.py --runs 20 --out bench.json
+#   DATABASE_URL=sqlite:///bench.db python bench.py --compare bench.json
+#
+# Для каждого запроса: p50/p95 задержки, число SQL-запросов и пиковая память
+# (tracemalloc, отдельным прогоном — он сам замедляет код). Кэш отчётов по
+# умолчанию сбрасывается перед каждым запросом (--warm — не сбрасывать).
+# Сценарии teacher_post и teacher_gradebook_post пишут оценки, поэтому без явного
+# DATABASE_URL скрипт не запускается — рабочая instance/data.db не тронется.
+import json, os, platform, statistics, sys, time, tracemalloc
+from datetime import datetime
+
+from sqlalchemy import event
+
+from app import app, db, report_cache, fragment_cache, grade_matrices, current_year, User, Subject, Grade, cli_option
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, len(values) * pct // 100)]
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def login_as(client, user):
+    with client.session_transaction() as s:
+        s["user_id"] = user.id
+
+
+def scenarios(year):
+    # (имя, роль, метод, url, данные формы) — данные могут зависеть от номера прогона
+    student = User.query.filter_by(role="student").order_by(User.id).first()
+    subject = Subject.query.order_by(Subject.id).first()
+    roster = [uid for (uid,) in db.session.query(User.id).filter_by(role="student")
+              .order_by(User.id).limit(50)]
+
+    def teacher_form(run):
+        form = {"subject": subject.id, "year": year, "quarter": 1, "week": 1}
+        # Чередуем значения, чтобы каждый прогон действительно обновлял оценки
+        form.update({f"student_{sid}": str(2 + (run + i) % 4) for i, sid in enumerate(roster)})
+        return form
+
+    def gradebook_form(run):
+        # Как правка в сетке: только изменённые ячейки одной недели
+        form = {"subject": 0, "year": year, "quarter": 1}
+        form.update({f"g_{subject.id}_{sid}_{1 + run % 10}": str(2 + (run + i) % 4)
+                     for i, sid in enumerate(roster)})
+        return form
+
+    return student, [
+        ("student", "student", "GET", "/student", None),
+        ("student_report", "student", "GET", f"/student/report?year={year}", None),
+        ("teacher_report", "teacher", "GET", f"/teacher/report?year={year}", None),
+        ("teacher_report_subject", "teacher", "GET",
+         f"/teacher/report?year={year}&subject={subject.id}", None),
+        ("teacher_post", "teacher", "POST", "/teacher", teacher_form),
+        ("teacher_gradebook", "teacher", "GET", f"/teacher/gradebook?year={year}&quarter=1", None),
+        ("teacher_gradebook_post", "teacher", "POST", "/teacher/gradebook", gradebook_form),
+        ("admin_reports", "admin", "GET", f"/admin/reports?year={year}", None),
+        ("admin_matrix", "admin", "GET", f"/admin/matrix?year={year}", None),
+        ("admin_analytics", "admin", "GET", f"/admin/analytics?year={year}", None),
+        ("export_teacher_xlsx", "teacher", "GET",
+         f"/export/teacher_xlsx?year={year}&subject={subject.id}", None),
+        ("export_teacher_xlsx_all", "admin", "GET", f"/export/teacher_xlsx?year={year}", None),
+        ("export_student_xlsx", "student", "GET", f"/export/student_xlsx?year={year}", None),
+        ("export_admin_xlsx", "admin", "GET", f"/export/admin_xlsx?year={year}", None),
+        ("export_grades_csv", "teacher", "GET",
+         f"/export/grades_csv?year={year}&subject={subject.id}", None),
+        ("export_grades_csv_all", "admin", "GET", f"/export/grades_csv?year={year}", None),
+        ("export_averages_csv", "admin", "GET", f"/export/averages_csv?year={year}", None),
+    ]
+
+
+def run(runs, warm, only):
+    app.config["TESTING"] = True
+    results = {}
+    with app.app_context():
+        year = current_year()
+        counter = QueryCounter(db.engine)
+        student, cases = scenarios(year)
+        users = {"student": student,
+                 "teacher": User.query.filter_by(username="teacher").first(),
+                 "admin": User.query.filter_by(role="admin").order_by(User.id).first()}
+        meta = {"started": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "database": db.engine.url.render_as_string(hide_password=True),
+                "students": User.query.filter_by(role="student").count(),
+                "grades": Grade.query.count(),
+                "runs": runs, "warm": warm}
+
+    for name, role, method, url, form in cases:
+        if only and name not in only:
+            continue
+        client = app.test_client()
+        with app.app_context():
+            login_as(client, users[role])
+
+        def call(i):
+            if not warm:
+                report_cache.invalidate(lambda key: True)
+                fragment_cache.invalidate(lambda key: True)
+                grade_matrices.clear()
+            data = form(i) if form else None
+            # buffered: тело CSV-выгрузок строится при чтении, его тоже меряем
+            return client.open(url, method=method, data=data, buffered=True)
+
+        call(0)  # прогрев: шаблоны, импорт, план запросов
+        times, queries, status = [], [], None
+        for i in range(1, runs + 1):
+            before = counter.count
+            started = time.perf_counter()
+            resp = call(i)
+            times.append((time.perf_counter() - started) * 1000)
+            queries.append(counter.count - before)
+            status = resp.status_code
+
+        tracemalloc.start()
+        call(runs + 1)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[name] = {"status": status,
+                         "p50_ms": round(percentile(times, 50), 2),
+                         "p95_ms": round(percentile(times, 95), 2),
+                         "mean_ms": round(statistics.mean(times), 2),
+                         "queries": max(queries),
+                         "peak_kb": round(peak / 1024)}
+        r = results[name]
+        print(f"{name:26} {r['status']}  p50 {r['p50_ms']:9.2f} ms  p95 {r['p95_ms']:9.2f} ms"
+              f"  queries {r['queries']:5}  peak {r['peak_kb']:7} KB", flush=True)
+
+    return {"meta": meta, "results": results}
+
+
+def compare(old, new):
+    print(f"\n{'':26} {'p50 old':>10} {'p50 new':>10} {'ratio':>7}  queries")
+    for name, r in new["results"].items():
+        o = old["results"].get(name)
+        if not o:
+            continue
+        ratio = r["p50_ms"] / o["p50_ms"] if o["p50_ms"] else 0
+        print(f"{name:26} {o['p50_ms']:10.2f} {r['p50_ms']:10.2f} {ratio:7.2f}  "
+              f"{o['queries']} → {r['queries']}")
+
+
+if __name__ == "__main__":
+    if not os.environ.get("DATABASE_URL"):
+        sys.exit("bench.py writes grades: set DATABASE_URL to a separate database, e.g.\n"
+                 "  DATABASE_URL=sqlite:///bench.db python bench.py")
+    # Позиционные аргументы — имена сценариев (по умолчанию все)
+    args = sys.argv[1:]
+    only = {a for i, a in enumerate(args)
+            if not a.startswith("--") and not (i and args[i - 1] in ("--runs", "--out", "--compare"))}
+    out = cli_option("out", "")
+    baseline = cli_option("compare", "")
+    report = run(cli_option("runs", 20), "--warm" in sys.argv, only)
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {out}")
+    if baseline:
+        with open(baseline, encoding="utf-8") as f:
+            compare(json.load(f), report)
@@ -0,0 +1,106 @@
+# bench_startup.py — время старта и память воркеров при pre-fork запуске.
+#
+#   python bench_startup.py --workers 4 --out startup.json
+#
+# Каждый режим запускается в отдельном интерпретаторе: «мастер» импортирует
+# app, вызывает create_app() (с предзагрузкой модулей или без) и делает fork
+# воркеров, как gunicorn с preload_app. Воркер вызывает after_fork(), отвечает
+# на первый запрос и (для режимов heavy) один раз строит xlsx и массив numpy.
+# Для мастера: время импорта app и RSS; для воркера: время до готовности,
+# RSS, PSS и приватная память (то, что воркер не делит с мастером).
+# Только Linux: память читается из /proc/self/smaps_rollup.
+import json, os, statistics, subprocess, sys, time
+
+MODES = {
+    # имя: (предзагрузка в мастере, воркер использует numpy/openpyxl)
+    "lazy": (False, False),
+    "lazy_heavy": (False, True),
+    "preload_heavy": (True, True),
+}
+
+
+def memory_kb():
+    # RSS, PSS и приватные страницы процесса (КБ)
+    values = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            name, _, rest = line.partition(":")
+            if rest.strip().endswith("kB"):
+                values[name] = int(rest.split()[0])
+    return {"rss_kb": values["Rss"], "pss_kb": values["Pss"],
+            "private_kb": values["Private_Clean"] + values["Private_Dirty"]}
+
+
+def worker(heavy, forked, out):
+    from app import app, after_fork, write_xlsx, np
+    after_fork()
+    app.test_client().get("/login")
+    if heavy:
+        write_xlsx("bench", lambda: iter([["ученик", "средний"], ["a", 4.5]]))
+        np.zeros((4, 100, 10)).sum()
+    sample = dict(ready_ms=round((time.perf_counter() - forked) * 1000, 1), **memory_kb())
+    os.write(out, (json.dumps(sample) + "\n").encode())
+
+
+def master(mode, workers):
+    preload, heavy = MODES[mode]
+    os.environ["PRELOAD"] = "1" if preload else "0"
+    started = time.perf_counter()
+    import app
+    imported = time.perf_counter()
+    app.create_app()
+    created = time.perf_counter()
+    result = {"import_ms": round((imported - started) * 1000, 1),
+              "create_app_ms": round((created - imported) * 1000, 1),
+              "master": memory_kb(), "workers": []}
+
+    read_end, write_end = os.pipe()
+    pids = []
+    for _ in range(workers):
+        forked = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            try:
+                worker(heavy, forked, write_end)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    os.close(write_end)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    with os.fdopen(read_end) as f:
+        result["workers"] = [json.loads(line) for line in f]
+    print(json.dumps(result))
+
+
+def run(workers):
+    env = dict(os.environ, SECRET_KEY=os.environ.get("SECRET_KEY", "bench-startup"),
+               MIGRATE_ON_START="0")
+    results = {}
+    for mode in MODES:
+        proc = subprocess.run([sys.executable, __file__, "--child", mode, str(workers)],
+                              env=env, capture_output=True, text=True, check=True)
+        r = results[mode] = json.loads(proc.stdout.strip().splitlines()[-1])
+        ws = r["workers"]
+        r["worker_mean"] = {key: round(statistics.mean(w[key] for w in ws), 1)
+                            for key in ("ready_ms", "rss_kb", "pss_kb", "private_kb")}
+        m = r["worker_mean"]
+        print(f"{mode:14} import {r['import_ms']:7.1f} ms  create_app {r['create_app_ms']:7.1f} ms"
+              f"  master RSS {r['master']['rss_kb'] // 1024:4} MB |"
+              f" worker ready {m['ready_ms']:7.1f} ms  RSS {m['rss_kb'] / 1024:5.1f} MB"
+              f"  PSS {m['pss_kb'] / 1024:5.1f} MB  private {m['private_kb'] / 1024:5.1f} MB", flush=True)
+    return {"workers": workers, "python": sys.version.split()[0], "results": results}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        master(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+    from app import cli_option
+    report = run(cli_option("workers", 4))
+    out = cli_option("out", "")
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {out}")
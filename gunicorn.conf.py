@@ -0,0 +1,28 @@
+# Настройки gunicorn:  gunicorn -c gunicorn.conf.py wsgi:app
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+# workers × threads — заодно предел одновременных проверок паролей (CPU)
+workers = int(os.environ.get("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+threads = int(os.environ.get("WEB_THREADS", 1))
+timeout = int(os.environ.get("WEB_TIMEOUT", 60))
+# Воркер перезапускается через столько запросов — ограничивает рост памяти
+max_requests = int(os.environ.get("WEB_MAX_REQUESTS", 2000))
+max_requests_jitter = max_requests // 10
+
+# Приложение импортируется и прогревается один раз в мастере (create_app),
+# воркеры получают его через fork
+preload_app = True
+
+# Кэши у каждого воркера свои. Отчёты и фрагменты сверяются с версиями данных
+# в БД (DataVersion), матрицы оценок догоняют журнал изменений (GradeChange),
+# поэтому запись в одном воркере видна остальным со следующего запроса.
+# Изменения в обход журнала (gendata, правка БД вручную) матрицы увидят
+# только после перезагрузки — её возраст ограничиваем. Пользователи сессии
+# кэшируются на USER_CACHE_TTL секунд.
+os.environ.setdefault("GRADE_MATRIX_MAX_AGE", "900")
+
+
+def post_fork(server, worker):
+    from app import after_fork
+    after_fork()
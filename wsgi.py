@@ -0,0 +1,5 @@
+# WSGI-вход для продакшена:  gunicorn -c gunicorn.conf.py wsgi:app
+# Настройки — переменные окружения (SECRET_KEY, DATABASE_URL, DB_PROFILE=production, ...)
+from app import create_app
+
+app = create_app()